@@ -1,7 +1,7 @@
 import os
 import csv
 from datetime import datetime
-from sqlalchemy import exc, update
+from sqlalchemy import exc, update, and_, bindparam
 from cuip.cuip.utils import cuiplogger
 from cuip.cuip.database.db_tables import ToFilesDB
 
@@ -74,6 +74,46 @@ class UpdateTask(object):
                            "Rolling back the commit before exiting")
             session.rollback()
 
+class UpdateRegistration(object):
+
+    def __init__(self, records, batch_size=1000):
+        """
+        Parameters
+        ----------
+        records: list
+            list of tuples of (fpath, fname, roffset, coffset, angle)
+            as returned by the registration
+        batch_size: int
+            number of rows updated per statement and commit
+        """
+        self.records    = records
+        self.batch_size = batch_size
+
+    def __call__(self, session=None, *args, **kwargs):
+        """
+        update the registration parameters of the files in bulk
+        """
+        upd = update(ToFilesDB). \
+            where(and_(ToFilesDB.fpath == bindparam('b_fpath'),
+                       ToFilesDB.fname == bindparam('b_fname'))). \
+                       values(roffset=bindparam('b_roffset'),
+                              coffset=bindparam('b_coffset'),
+                              angle=bindparam('b_angle'))
+        nupd = 0
+        for ii in range(0, len(self.records), self.batch_size):
+            batch = [{'b_fpath': rec[0], 'b_fname': rec[1],
+                      'b_roffset': float(rec[2]), 'b_coffset': float(rec[3]),
+                      'b_angle': float(rec[4])}
+                     for rec in self.records[ii:ii+self.batch_size]]
+            try:
+                session.execute(upd, batch)
+                session.commit()
+                nupd += len(batch)
+            except exc.SQLAlchemyError as ex:
+                logger.error("Error updating registration: "+str(ex))
+                session.rollback()
+        return nupd
+
 class ToCSV(object):
     
     def __init__(self, where_clause=None, compare_value=None):
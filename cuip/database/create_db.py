@@ -1,3 +1,11 @@
+"""
+Create the files and weather tables of the database (CUIP_DBNAME)
+if they do not exist and fill them in.
+
+Tables created before roffset/coffset became Float store them as
+Integer; run migrate_db.py once on such a database so that the
+subpixel registration offsets are not truncated.
+"""
 import os
 import multiprocessing
 import datetime
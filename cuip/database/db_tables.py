@@ -22,8 +22,8 @@ class ToFilesDB(Base):
     visibility    = Column('visibility',  Float)
     cloud         = Column('conditions',  String(length=50, convert_unicode=True))
     temperature   = Column('temperature', Float)
-    roffset       = Column('roffset',     Integer)
-    coffset       = Column('coffset',     Integer)
+    roffset       = Column('roffset',     Float)
+    coffset       = Column('coffset',     Float)
     angle         = Column('angle',       Float)
     usable        = Column('usable',      Boolean)
     fnumber       = Column(Integer, Sequence('fnumber'))
@@ -0,0 +1,46 @@
+import os
+from sqlalchemy import create_engine, inspect, Float
+from cuip.cuip.utils import cuiplogger
+from cuip.cuip.database import db_tables
+
+# logger
+logger = cuiplogger.cuipLogger(loggername="MigrateDB", tofile=False)
+
+def migrate_registration(engine):
+    """
+    Migrate an existing files table to the current schema in which
+    the registration offsets (roffset, coffset) are Float.  Tables
+    created before that change store them as Integer, so subpixel
+    offsets written by UpdateRegistration are silently truncated
+    until this is run.  Columns that are already Float are left
+    untouched, so it is safe to run more than once.
+
+    Parameters
+    ----------
+    engine: sqlalchemy.engine.Engine
+        engine of the files database
+
+    Returns
+    -------
+    altered: list
+        names of the altered columns
+    """
+    table = db_tables.ToFilesDB.__table__
+    types = dict((col["name"], col["type"]) for col in
+                 inspect(engine).get_columns(table.name))
+    altered = []
+    for name in ["roffset", "coffset"]:
+        if isinstance(types[name], Float):
+            continue
+        logger.info("converting {0}.{1} to double precision" \
+                        .format(table.name, name))
+        engine.execute('ALTER TABLE "{0}" ALTER COLUMN {1} TYPE '
+                       'double precision'.format(table.name, name))
+        altered.append(name)
+    return altered
+
+
+if __name__ == "__main__":
+    dbname = os.getenv("CUIP_DBNAME")
+    engine = create_engine('postgresql:///{0}'.format(dbname))
+    migrate_registration(engine)
@@ -5,11 +5,18 @@ Date: 25 May 2016
 """
 
 import os
+import multiprocessing
+import threading
+from multiprocessing.pool import ThreadPool
 from math import asin
 import numpy as np
+import pandas as pd
 import pylab as pl
 import cv2
-from scipy.ndimage.filters import convolve
+from scipy.ndimage.filters import convolve, maximum_filter
+from cuip.cuip.utils import cuiplogger
+
+logger = cuiplogger.cuipLogger(loggername="DETECT_MATCH", tofile=False)
 
 # Globals
 CAMHEIGHT, CAMWIDTH = (2160, 4096)
@@ -212,15 +219,53 @@ def gray3(img):
     return gray_to_3(g)
 
 
+def _bincount_unique(img, return_inverse=False):
+    """
+    Same output as np.unique(img, return_counts=True,
+    return_inverse=return_inverse) for an image of non-negative bounded
+    integers, computed in linear time with np.bincount and a lookup table
+    from value to index.
+    """
+    flat = img.ravel()
+    counts = np.bincount(flat)
+    present = np.flatnonzero(counts)
+
+    thereturn = (present.astype(img.dtype), )
+    if return_inverse:
+        lut = np.zeros(counts.size, dtype=np.intp)
+        lut[present] = np.arange(present.size)
+        thereturn += (lut[flat], )
+
+    return thereturn + (counts[present], )
+
+
+def _bincountable(img):
+    """
+    Whether the values of img are small enough non-negative integers for
+    _bincount_unique (the histogram is at most 4 times the image size).
+    """
+    return (img.size > 0 and img.dtype.kind in 'ui' and
+            img.dtype.itemsize <= 4 and img.min() >= 0 and
+            img.max() < max(2**16, 4 * img.size))
+
+
 def img_cdf(img, return_inverse=False):
     """
     Calculate the CDF of an image using quicksort. Optional returns from
     np.unique provide the histogram counts and indices for reconstruction of
     the image. The CDF is returned from the normalized cumulative sum of the
     counts.
+
+    Images of bounded non-negative integers (e.g. uint8 or the weighted
+    images of neighborhood_cdf) are histogrammed with np.bincount instead
+    of sorted, which gives identical output in linear time.
     """
 
-    uniq = np.unique(img, return_counts=True, return_inverse=return_inverse)
+    if _bincountable(img):
+        uniq = _bincount_unique(img, return_inverse=return_inverse)
+    else:
+        uniq = np.unique(img, return_counts=True,
+                         return_inverse=return_inverse)
     c = uniq[0]
     f = uniq[-1]
     f = np.cumsum(f).astype(np.float_)
@@ -556,6 +601,468 @@ def calculate_img_offset_batch(ref, flist, histmatch = False,
             print 'dt = ', asin(rt[1,0])
     return rt
 
+def make_detector(name, tiles=None, **kwargs):
+    """
+    Return a feature detector ('sift', 'surf' or 'orb') for either the
+    OpenCV 2.4 or the OpenCV 3+ API. Detectors cannot be pickled, so
+    worker processes create their own by name.
+
+    If tiles (number of tile rows and cols) is given, return a
+    TiledDetector (kwargs are passed to it). Use tiled_detector to
+    build one from a dict of TiledDetector keyword arguments.
+    """
+    if tiles is not None:
+        return TiledDetector(name, tiles=tiles, **kwargs)
+    if kwargs:
+        raise ValueError('TiledDetector arguments {} given without '
+                         'tiles'.format(sorted(kwargs)))
+    name = name.lower()
+    if name not in ['sift', 'surf', 'orb']:
+        errmsg = 'Detection algorithm {} not supported ' \
+                 '(must be one of sift, surf, orb)'.format(name)
+        raise ValueError(errmsg)
+    if name == 'orb':
+        return cv2.ORB_create() if hasattr(cv2, 'ORB_create') else cv2.ORB()
+    if hasattr(cv2, 'xfeatures2d'):
+        return getattr(cv2.xfeatures2d, name.upper() + '_create')()
+    return getattr(cv2, name.upper())()
+
+
+def tiled_detector(name, tiling=None):
+    """
+    Return a TiledDetector built with the keyword arguments tiling
+    (its defaults apply to the missing ones, e.g., tiles) or, if tiling
+    is empty, the full-frame detector.
+    """
+    if tiling:
+        return TiledDetector(name, **tiling)
+    return make_detector(name)
+
+
+def keypoint_array(kp):
+    """
+    Return the (x, y) positions of a list of keypoints as an (n, 2)
+    float32 array.
+    """
+    return np.array([k.pt for k in kp], dtype=np.float32).reshape(-1, 2)
+
+
+def match_points(pts1, pts2, matches, ratio=0.8):
+    """
+    Apply the ratio test to the knn (k=2) matches and return the
+    matched (x, y) positions in the first and second image as two
+    (n, 1, 2) float32 arrays.
+    """
+    pairs = [mn for mn in matches if len(mn) == 2]
+    if len(pairs) == 0:
+        empty = np.zeros((0, 1, 2), dtype=np.float32)
+        return empty, empty
+
+    # indices and distances of the best and second best matches
+    arr  = np.array([(m.queryIdx, m.trainIdx, m.distance, n.distance)
+                     for m, n in pairs])
+    good = arr[:, 2] < ratio * arr[:, 3]
+    qidx = arr[good, 0].astype(int)
+    tidx = arr[good, 1].astype(int)
+
+    return pts1[qidx].reshape(-1, 1, 2), pts2[tidx].reshape(-1, 1, 2)
+
+
+def rigid_transform(src, dst, thresh=5.0):
+    """
+    Return the rigid (rotation, translation and scale) transform from
+    the src to the dst points fit to the RANSAC inliers, and the
+    number of inliers (None, 0 if the fit fails).
+    """
+    if hasattr(cv2, 'estimateAffinePartial2D'):
+        rt, mask = cv2.estimateAffinePartial2D(src, dst, method=cv2.RANSAC,
+                                               ransacReprojThreshold=thresh)
+        ninl = 0 if mask is None else int(mask.sum())
+        return rt, ninl
+
+    # don't really need a homography, but getAffineTransform doesn't seem
+    # to support RANSAC
+    M, mask = cv2.findHomography(src, dst, cv2.RANSAC, thresh)
+    if mask is None:
+        return None, 0
+    inl = mask.ravel().astype(bool)
+    rt  = cv2.estimateRigidTransform(src[inl].reshape(1, -1, 2),
+                                     dst[inl].reshape(1, -1, 2), False)
+    return rt, int(inl.sum())
+
+
+def window_mask(fname=None, buff=20, dilate=40):
+    """
+    Return the static scene mask (uint8, 255 on the scene) of the window
+    sources: the window labels (window_labels.out in CUIP_SUPPLEMENTARY)
+    dilated by dilate pixels to include the surrounding building
+    structure (and to allow for the offsets of the frames). Sky and
+    water have no windows and are excluded.
+    """
+    if fname is None:
+        fname = os.path.join(os.getenv('CUIP_SUPPLEMENTARY'),
+                             'window_labels.out')
+    srcs = np.zeros((CAMHEIGHT, CAMWIDTH), dtype=np.uint8)
+    srcs[buff:-buff, buff:-buff] = np.fromfile(fname, int) \
+        .reshape(CAMHEIGHT - 2 * buff, CAMWIDTH - 2 * buff) \
+        .astype(bool)
+    if dilate > 0:
+        srcs = maximum_filter(srcs, size=2 * dilate + 1)
+    return srcs * np.uint8(255)
+
+
+class TiledDetector(object):
+    """
+    Feature detection on tiles of the image, restricted to a mask and
+    run in a pool of threads (OpenCV releases the GIL while detecting).
+
+    Each tile is detected with overlap pixels of margin, only the
+    keypoints in the tile itself are kept (so there are no duplicates
+    at the edges) and, of those, the max_per_tile strongest. Descriptors
+    are computed only for the kept keypoints. Tiles without any mask
+    pixel are skipped. This gives fewer, better distributed keypoints
+    and less detection and matching time than detecting the full
+    frame.
+
+    Has the detectAndCompute interface of the OpenCV detectors, so it
+    can be passed as detectAlgo to feature_find.
+
+    Parameters
+    ----------
+    detector: str
+        feature detector of the tiles ('sift', 'surf' or 'orb')
+    tiles: tuple
+        number of tile rows and cols
+    mask: np.ndarray, optional
+        (rows, cols) mask of the static scene (non-zero where keypoints
+        are detected), e.g., window_mask()
+    max_per_tile: int
+        maximum number of keypoints per tile (None for no limit)
+    overlap: int
+        margin (pixels) around each tile used for the detection
+    nthreads: int, optional
+        number of threads (default: number of cpus)
+    """
+
+    def __init__(self, detector='sift', tiles=(4, 8), mask=None,
+                 max_per_tile=250, overlap=32, nthreads=None):
+        self.detector = detector.lower()
+        self.tiles = tiles
+        self.mask = None if mask is None else \
+            np.ascontiguousarray(mask != 0, dtype=np.uint8)
+        self.max_per_tile = max_per_tile
+        self.overlap = overlap
+        self.nthreads = nthreads or multiprocessing.cpu_count()
+        self._shape = None
+        self._pool = None
+        self._local = threading.local()
+
+        # -- check the detector name
+        make_detector(self.detector)
+
+    def _tile_windows(self, shape):
+        """
+        Return the (core, window) row/col bounds of the tiles of an
+        image shape that have mask pixels in their core.
+        """
+        nrow, ncol = shape[:2]
+        rb = np.linspace(0, nrow, self.tiles[0] + 1).astype(int)
+        cb = np.linspace(0, ncol, self.tiles[1] + 1).astype(int)
+        ov = self.overlap
+
+        windows = []
+        for r0, r1 in zip(rb[:-1], rb[1:]):
+            for c0, c1 in zip(cb[:-1], cb[1:]):
+                if self.mask is not None and not self.mask[r0:r1,
+                                                           c0:c1].any():
+                    continue
+                windows.append(((r0, r1, c0, c1),
+                                (max(r0 - ov, 0), min(r1 + ov, nrow),
+                                 max(c0 - ov, 0), min(c1 + ov, ncol))))
+        return windows
+
+    def _detect_tile(self, args):
+        """
+        Return the keypoints (image coordinates) and descriptors of one
+        tile.
+        """
+        img, (r0, r1, c0, c1), (wr0, wr1, wc0, wc1) = args
+
+        # -- one detector per thread (they are not thread safe)
+        if not hasattr(self._local, 'detectAlgo'):
+            self._local.detectAlgo = make_detector(self.detector)
+        detectAlgo = self._local.detectAlgo
+
+        sub  = img[wr0:wr1, wc0:wc1]
+        mask = None if self.mask is None else self.mask[wr0:wr1, wc0:wc1]
+        kp   = detectAlgo.detect(sub, mask)
+
+        # -- keep the strongest keypoints in the core of the tile
+        kp = [k for k in kp if (r0 <= k.pt[1] + wr0 < r1) and
+              (c0 <= k.pt[0] + wc0 < c1)]
+        if self.max_per_tile is not None and len(kp) > self.max_per_tile:
+            kp = sorted(kp, key=lambda k: -k.response)[:self.max_per_tile]
+        if len(kp) == 0:
+            return [], None
+
+        kp, des = detectAlgo.compute(sub, kp)
+        for k in kp:
+            k.pt = (k.pt[0] + wc0, k.pt[1] + wr0)
+        return kp, des
+
+    def detectAndCompute(self, img, mask=None):
+        """
+        Detect the keypoints on the tiles of an image and compute their
+        descriptors. Returns the keypoints and descriptors (None if there
+        are no keypoints) as the OpenCV detectors. The mask argument is
+        ignored (the mask of the detector is used).
+        """
+        if self._shape != img.shape[:2]:
+            if self.mask is not None and self.mask.shape != img.shape[:2]:
+                raise ValueError('mask shape {} does not match image '
+                                 'shape {}'.format(self.mask.shape,
+                                                   img.shape[:2]))
+            self._windows = self._tile_windows(img.shape)
+            self._shape = img.shape[:2]
+        if self._pool is None:
+            self._pool = ThreadPool(self.nthreads)
+
+        res = self._pool.map(self._detect_tile,
+                             [(img, core, win) for core, win in self._windows])
+        kp  = [k for kpi, _ in res for k in kpi]
+        des = [dsi for _, dsi in res if dsi is not None]
+
+        return kp, (np.vstack(des) if len(des) > 0 else None)
+
+    def close(self):
+        """
+        Terminate the thread pool.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+# FLANN index parameters (see flann/defines.h)
+FLANN_INDEX_KDTREE = 1
+FLANN_INDEX_LSH = 6
+
+# reference indexes loaded in this process
+_ref_indexes = {}
+
+class ReferenceIndex(object):
+    """
+    Keypoints and descriptors of a reference image together with a
+    trained FLANN index of the descriptors (LSH for binary descriptors
+    such as ORB, randomized kd-trees otherwise).
+
+    The keypoint positions and descriptors are saved to disk with
+    `save` so that the reference is detected only once for all jobs,
+    and the index is trained once per process (it is rebuilt on load
+    and on unpickling, e.g., in worker processes).
+
+    Parameters
+    ----------
+    pts: np.ndarray
+        (n, 2) float32 (x, y) positions of the reference keypoints
+    des: np.ndarray
+        (n, m) descriptors of the reference keypoints
+    detector: str
+        name of the detector that produced them ('sift', 'surf', 'orb')
+    searchParams: dict
+        FLANN search parameters
+    """
+
+    def __init__(self, pts, des, detector='sift',
+                 searchParams=dict(checks=50)):
+        self.pts = np.asarray(pts, dtype=np.float32).reshape(-1, 2)
+        self.des = np.asarray(des)
+        self.detector = detector.lower()
+        self.searchParams = searchParams
+        self._train()
+
+    def _train(self):
+        """
+        Build and train the FLANN index of the descriptors.
+        """
+        if self.des.dtype == np.uint8:
+            indexParams = dict(algorithm=FLANN_INDEX_LSH, table_number=6,
+                               key_size=12, multi_probe_level=1)
+        else:
+            self.des = self.des.astype(np.float32)
+            indexParams = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
+        self.matcher = cv2.FlannBasedMatcher(indexParams, self.searchParams)
+        self.matcher.add([self.des])
+        self.matcher.train()
+
+    def __getstate__(self):
+        # the trained matcher cannot be pickled
+        state = self.__dict__.copy()
+        del state['matcher']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._train()
+
+    @classmethod
+    def from_image(cls, img, detector='sift', tiling=None, **kwargs):
+        """
+        Detect the keypoints of a reference image and index them (on
+        tiles if tiling, the keyword arguments of TiledDetector, is
+        given).
+        """
+        detectAlgo = tiled_detector(detector, tiling)
+        kp, des = feature_find(gray(img), detectAlgo=detectAlgo)
+        if isinstance(detectAlgo, TiledDetector):
+            detectAlgo.close()
+        return cls(keypoint_array(kp), des, detector=detector, **kwargs)
+
+    def save(self, fname):
+        """
+        Write the keypoint positions, descriptors and detector name.
+        """
+        with open(fname + '.tmp', 'wb') as fh:
+            np.savez(fh, pts=self.pts, des=self.des, detector=self.detector)
+        os.rename(fname + '.tmp', fname)
+
+    @classmethod
+    def load(cls, fname):
+        """
+        Return the index of a saved reference (each file is loaded and
+        trained once per process).
+        """
+        fname = os.path.abspath(fname)
+        if fname not in _ref_indexes:
+            with np.load(fname) as ref:
+                _ref_indexes[fname] = cls(ref['pts'], ref['des'],
+                                          detector=str(ref['detector']))
+        return _ref_indexes[fname]
+
+    def match(self, pts2, des2, ratio=0.8):
+        """
+        Match the descriptors of an image to the reference and return the
+        matched (x, y) positions in the reference and in the image as two
+        (n, 1, 2) float32 arrays.
+        """
+        if des2 is None or len(des2) < 2:
+            empty = np.zeros((0, 1, 2), dtype=np.float32)
+            return empty, empty
+        if des2.dtype != self.des.dtype:
+            des2 = des2.astype(self.des.dtype)
+        matches = self.matcher.knnMatch(des2, k=2)
+        dst, src = match_points(pts2, self.pts, matches, ratio=ratio)
+        return src, dst
+
+
+# state of the offset_batch worker processes
+_offset = {}
+
+def _init_offset(index, ref, histmatch, ratio, min_matches, tiling):
+    """
+    Create the detector once per worker process (the reference index is
+    trained when it is unpickled).
+    """
+    if isinstance(index, basestring):
+        index = ReferenceIndex.load(index)
+    detectAlgo = tiled_detector(index.detector, tiling)
+    _offset.update(index=index, detectAlgo=detectAlgo,
+                   ref=ref, histmatch=histmatch, ratio=ratio,
+                   min_matches=min_matches)
+
+
+def _offset_one(f):
+    """
+    Return (fname, dx, dy, dtheta, n_inliers) of one file (NaN offsets
+    if the transform cannot be found, errors are logged).
+    """
+    try:
+        img2 = loadRAW(f)
+        if _offset['histmatch']:
+            img2 = np.uint8(hist_match(_offset['ref'], img2))
+        else:
+            img2 = gray(img2)
+
+        kp2, des2 = feature_find(img2, detectAlgo=_offset['detectAlgo'])
+        src, dst  = _offset['index'].match(keypoint_array(kp2), des2,
+                                           ratio=_offset['ratio'])
+        if len(src) <= _offset['min_matches']:
+            return f, np.nan, np.nan, np.nan, 0
+
+        rt, ninl = rigid_transform(src, dst)
+        if rt is None:
+            return f, np.nan, np.nan, np.nan, ninl
+        return f, rt[0, 2], rt[1, 2], np.arctan2(rt[1, 0], rt[0, 0]), ninl
+    except Exception as ex:
+        logger.error("Error finding the offset of "+str(f)+": "+str(ex))
+        return f, np.nan, np.nan, np.nan, 0
+
+
+def offset_batch(ref, flist, detector='sift', nproc=None, histmatch=False,
+                 ratio=0.8, min_matches=10, chunksize=4, tiling=None):
+    """
+    Headless, parallel version of calculate_img_offset_batch.
+
+    Find the rigid transform between the reference and every file in
+    flist with a pool of processes.
+
+    Parameters
+    ----------
+    ref: np.ndarray, ReferenceIndex or str
+        reference image (rows, cols, 3), reference index, or file name
+        of a saved reference index
+    flist: list
+        raw files to register
+    detector: str
+        feature detector ('sift', 'surf' or 'orb') used if ref is an
+        image (otherwise the detector of the index is used)
+    nproc: int, optional
+        number of worker processes (default: number of cpus)
+    histmatch: bool
+        match the histogram of each image to the reference (ref must
+        be an image)
+    ratio: float
+        ratio test threshold of the knn matches
+    min_matches: int
+        minimum number of matches to fit a transform
+    chunksize: int
+        number of files sent to a worker at once
+    tiling: dict, optional
+        keyword arguments of TiledDetector (e.g., tiles, mask,
+        max_per_tile, nthreads) to detect on tiles restricted to a
+        mask; nthreads threads run in each of the nproc processes
+
+    Returns
+    -------
+    pandas DataFrame with columns fname, dx, dy, dtheta (radians) and
+    n_inliers, in the order of flist
+    """
+    # detect the reference once (workers get the keypoints and
+    # descriptors and train their own index)
+    image = ref if isinstance(ref, np.ndarray) else None
+    if image is not None:
+        index = ReferenceIndex.from_image(image, detector=detector,
+                                          tiling=tiling)
+    else:
+        index = ref
+    if histmatch and image is None:
+        raise ValueError('histmatch requires a reference image')
+
+    pool = multiprocessing.Pool(nproc or multiprocessing.cpu_count(),
+                                initializer=_init_offset,
+                                initargs=(index, image, histmatch, ratio,
+                                          min_matches, tiling))
+    try:
+        res = pool.map(_offset_one, flist, chunksize=chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+    return pd.DataFrame(res, columns=['fname', 'dx', 'dy', 'dtheta',
+                                      'n_inliers'])
+
+
 # def calculate_img_offset_batch(ref, flist, histmatch = False,
 #         detectAlgo=cv2.SIFT(), **matchops):
 #     '''
@@ -663,8 +1170,7 @@ if __name__ == '__main__':
     flist = os.listdir(thedir)
     #ref = loadRAW(thedir + flist[0])   # stable results! (but correct?)
     ref = loadRAW(fname)                # unstable results! (and definitely wrong)
-    pl.imshow(gray(ref), cmap='gray')
-    pl.show()
     flist = [thedir + f for f in flist]
-    calculate_img_offset_batch(ref, flist, histmatch = False, detectAlgo=cv2.ORB())
+    offsets = offset_batch(ref, flist, detector='orb', histmatch=False)
+    offsets.to_csv('detect_match_offsets.csv', index=False)
 
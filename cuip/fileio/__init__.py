@@ -1 +1,4 @@
 from cuip_io import *
+from prefetch import *
+from batch import *
+from manifest import *
@@ -0,0 +1,116 @@
+import numpy as np
+import cia
+
+class FrameBatch(object):
+    """
+    Batch of frames stored as a single contiguous array of
+    shape (N, nrows, ncols, nwavs) with the per frame metadata
+    held in parallel numpy arrays.
+
+    Indexing with an integer returns a CuipImageArray view of
+    that frame. Indexing with a slice returns a FrameBatch whose
+    arrays are views into this one (boolean or integer array
+    indexing returns a copy, as with numpy).
+
+    Parameters
+    ----------
+    data: np.ndarray
+        array of shape (N, nrows, ncols, nwavs)
+    timestamps: 1-d array, optional
+        timestamps of the frames (stored as datetime64[s])
+    fnumbers: 1-d array, optional
+        file numbers of the frames (-1 if unknown)
+    paths: 1-d array or list, optional
+        source files of the frames (absolute paths, or the
+        file names of the filenames mapping for frames read
+        from stacked files)
+    """
+
+    def __init__(self, data, timestamps=None, fnumbers=None, paths=None):
+        self.data = np.asarray(data)
+        if self.data.ndim != 4:
+            raise ValueError("data must be of shape (N, nrows, ncols, nwavs)")
+        nfr = self.data.shape[0]
+
+        if timestamps is None:
+            timestamps = np.full(nfr, np.datetime64("NaT"), "datetime64[s]")
+        if fnumbers is None:
+            fnumbers = np.full(nfr, -1, dtype=np.int64)
+        if paths is None:
+            paths = np.full(nfr, "", dtype=object)
+
+        self.timestamps = np.asarray(timestamps, dtype="datetime64[s]")
+        self.fnumbers   = np.asarray(fnumbers, dtype=np.int64)
+        self.paths      = np.asarray(paths, dtype=object)
+
+        for name in ["timestamps", "fnumbers", "paths"]:
+            if getattr(self, name).shape != (nfr,):
+                raise ValueError("{0} must have length {1}".format(name, nfr))
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return cia.CuipImageArray(img_array=self.data[key],
+                                      metadata={"fname": self.paths[key],
+                                                "fnumber": self.fnumbers[key],
+                                                "timestamp":
+                                                self.timestamps[key]})
+        return FrameBatch(self.data[key], timestamps=self.timestamps[key],
+                          fnumbers=self.fnumbers[key], paths=self.paths[key])
+
+    def __iter__(self):
+        for ii in range(len(self)):
+            yield self[ii]
+
+    def tolist(self):
+        """
+        Return the frames as a list of CuipImageArray views
+        """
+        return list(self)
+
+    def sort(self):
+        """
+        Return a FrameBatch ordered by timestamp (and file
+        number for frames with equal or unknown timestamps)
+        """
+        order = np.lexsort((self.fnumbers, self.timestamps))
+        if (order == np.arange(len(self))).all():
+            return self
+        return self[order]
+
+    @classmethod
+    def fromarrays(cls, imgs):
+        """
+        Create a FrameBatch by copying a list of CuipImageArray
+        (or np.ndarray) frames into one contiguous buffer.
+        The metadata keys `fname`, `fnumber` and `timestamp` are
+        used if present.
+        """
+        def _meta(img, key, default):
+            metadata = getattr(img, "metadata", None) or {}
+            return metadata.get(key, default)
+
+        data = np.empty((len(imgs),) + imgs[0].shape, dtype=imgs[0].dtype)
+        for ii, img in enumerate(imgs):
+            data[ii] = img
+        return cls(data,
+                   timestamps=[_meta(img, "timestamp", np.datetime64("NaT"))
+                               for img in imgs],
+                   fnumbers=[_meta(img, "fnumber", -1) for img in imgs],
+                   paths=[_meta(img, "fname", "") for img in imgs])
+
+    @classmethod
+    def concatenate(cls, batches):
+        """
+        Concatenate a list of FrameBatch into one
+        """
+        return cls(np.concatenate([b.data for b in batches]),
+                   timestamps=np.concatenate([b.timestamps for b in batches]),
+                   fnumbers=np.concatenate([b.fnumbers for b in batches]),
+                   paths=np.concatenate([b.paths for b in batches]))
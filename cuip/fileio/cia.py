@@ -30,3 +30,15 @@ class CuipImageArray(np.ndarray):
         if obj is None: return
         self.comment = getattr(obj, 'comment', None)
         self.metadata = getattr(obj, 'metadata', None)
+
+    def __reduce__(self):
+        # add the attributes to the pickled state so that
+        # they survive being shipped between spark workers
+        pickled = super(CuipImageArray, self).__reduce__()
+        state   = pickled[2] + (self.comment, self.metadata)
+        return (pickled[0], pickled[1], state)
+
+    def __setstate__(self, state):
+        self.comment  = state[-2]
+        self.metadata = state[-1]
+        super(CuipImageArray, self).__setstate__(state[:-2])
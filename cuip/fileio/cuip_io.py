@@ -1,6 +1,8 @@
 import os
 import numpy as np
 import cia
+from batch import FrameBatch
+from manifest import manifest_name, read_manifest
 from operator import itemgetter
 from itertools import repeat
 from cuip.cuip.utils import cuiplogger
@@ -18,7 +20,151 @@ def _reshape(arr, nrows, ncols, nwavs, nstack=1):
     except Exception as ex:
         logger.error("Error reshaping the array: "+str(ex))
 
-def fromfile(fpath, fname, nrows, ncols, nwavs, filenames, nstack, dtype, sc):
+def _readstack(fpath, nrows, ncols, nwavs, nstack, dtype, mmap=False):
+    """
+    Return the stacked file as an array of shape
+    (nstack, nrows, ncols, nwavs)
+
+    Parameters
+    ----------
+    fpath: str
+        absolute path of the stacked file
+    nrows, ncols, nwavs: int
+        shape of each subimage
+    nstack: int
+        number of subimages in the file
+    dtype: data type of the image
+    mmap: bool
+        True: return a read-only `np.memmap` of the file.
+            Only the pages of the subimages that are accessed
+            will be read from disk
+        False: read the entire file into memory
+    """
+    if mmap:
+        return np.memmap(fpath, dtype=dtype, mode="r",
+                         shape=(nstack, nrows, ncols, nwavs))
+    return np.fromfile(fpath, dtype).reshape(nstack, nrows, ncols, nwavs)
+
+def _fromrecords(sc, flist, filenames, nrows, ncols, nwavs, dtype):
+    """
+    Read stacked files as fixed length binary records, one
+    record per subimage, and return an RDD of CuipImageArray
+    with metadata containing gname, fname and the index of
+    the subimage in the stacked file.
+
+    .. note: `sc.binaryRecords` drops the record index, so the
+             files are read with the same input format
+             (`FixedLengthBinaryInputFormat`), which keys each
+             record by its position in the file.
+
+    .. note: one RDD is created per file and they are joined with
+             `sc.union`, so the driver side cost grows with the
+             number of files.  This is fine for a night of stacks
+             but not for thousands of files at once; split such
+             lists into several calls.
+
+    Parameters
+    ----------
+    sc: sparkContext
+    flist: list
+        list of stacked files
+    filenames: dict
+        dictionary of list of filenames with f_range as key
+    nrows, ncols, nwavs: int
+        shape of the image
+    dtype: data type of the image
+    """
+    reclen = nrows * ncols * nwavs * np.dtype(dtype).itemsize
+    conf   = {"org.apache.spark.input.FixedLengthBinaryInputFormat." \
+                  "recordLength": str(reclen)}
+
+    def _tocia(gname, fnames):
+        """
+        Return a function mapping a (index, record) pair
+        to a list containing a CuipImageArray
+        """
+        def _map(rec):
+            idx, buf = rec
+            if idx >= len(fnames):
+                return []
+            # -- zero copy view of the record
+            img = np.frombuffer(buf, dtype=dtype).reshape(nrows, ncols, nwavs)
+            return [cia.CuipImageArray(img_array=img,
+                                       metadata={"gname": gname,
+                                                 "fname": fnames[idx],
+                                                 "index": idx})]
+        return _map
+
+    rdds = []
+    for fpath in flist:
+        fnames = filenames[os.path.basename(fpath).strip(".raw")]
+        recs   = sc.newAPIHadoopFile(fpath,
+                     "org.apache.spark.input.FixedLengthBinaryInputFormat",
+                     "org.apache.hadoop.io.LongWritable",
+                     "org.apache.hadoop.io.BytesWritable",
+                     conf=conf)
+        rdds.append(recs.flatMap(_tocia(fpath, fnames)))
+    return sc.union(rdds)
+
+def _stackmeta(fpath, count):
+    """
+    Return the file numbers and timestamps of the first count
+    subimages of a stacked file, from its manifest if there is
+    one.  Otherwise the file numbers are taken from the
+    `<first fnumber>_<last fnumber>` name when the range holds
+    exactly count files, and are -1 (timestamps NaT) if not.
+    """
+    fnumbers   = np.full(count, -1, dtype=np.int64)
+    timestamps = np.full(count, np.datetime64("NaT"), "datetime64[s]")
+
+    if os.path.isfile(manifest_name(fpath)):
+        mft = read_manifest(fpath)[:count]
+        fnumbers[:len(mft)]   = mft["fnumber"]
+        timestamps[:len(mft)] = mft["timestamp"]
+        return fnumbers, timestamps
+
+    try:
+        first, last = [int(i) for i in
+                       os.path.basename(fpath).strip(".raw").split("_")]
+    except ValueError:
+        return fnumbers, timestamps
+    if last - first + 1 == count:
+        fnumbers[:] = np.arange(first, last + 1)
+    return fnumbers, timestamps
+
+def _tobatch(flist, filenames, nrows, ncols, nwavs, nstack, dtype, mmap):
+    """
+    Read a list of stacked files into a single FrameBatch.
+    The file numbers and timestamps of the frames are taken
+    from the manifests of the stacked files (see `_stackmeta`).
+    If there is only one file and mmap is True, the batch
+    is a view into the memory mapped file
+    """
+    stacks = [(fpath, filenames[os.path.basename(fpath).strip(".raw")])
+              for fpath in flist]
+    paths  = [fname for fpath, fnames in stacks for fname in fnames[:nstack]]
+    meta   = [_stackmeta(fpath, min(nstack, len(fnames)))
+              for fpath, fnames in stacks]
+    fnums  = np.concatenate([fnum for fnum, tstamp in meta])
+    tstmps = np.concatenate([tstamp for fnum, tstamp in meta])
+
+    if mmap and len(stacks) == 1:
+        data = _readstack(stacks[0][0], nrows, ncols, nwavs, nstack, dtype,
+                          mmap=True)[:len(paths)]
+        return FrameBatch(data, timestamps=tstmps, fnumbers=fnums,
+                          paths=paths)
+
+    data  = np.empty((len(paths), nrows, ncols, nwavs), dtype=dtype)
+    first = 0
+    for fpath, fnames in stacks:
+        count = min(nstack, len(fnames))
+        data[first:first+count] = _readstack(fpath, nrows, ncols, nwavs,
+                                             nstack, dtype, mmap=True)[:count]
+        first += count
+    return FrameBatch(data, timestamps=tstmps, fnumbers=fnums, paths=paths)
+
+def fromfile(fpath, fname, nrows, ncols, nwavs, filenames, nstack, dtype, sc,
+             mmap=False, asbatch=False):
     """
     Read image file to a rdd as binary file if sc is passed
     else return the file content as a numpy array
@@ -43,36 +189,32 @@ def fromfile(fpath, fname, nrows, ncols, nwavs, filenames, nstack, dtype, sc):
     sc: sparkContext
         if calling the function in spark cluster, this
         function will return a RDD of binary file
+    mmap: bool, optional
+        if True, the subimages will be views into a
+        read-only `np.memmap` of the file instead of
+        being read into memory (ignored if sc is passed)
+    asbatch: bool, optional
+        if True, return a single FrameBatch instead of a
+        list of CuipImageArray (ignored if sc is passed)
     Returns
     -------
-    numpy.array OR spark RDD
+    list of CuipImageArray OR FrameBatch OR spark RDD of CuipImageArray
     """
     # create dictionary of filenames with f_number as the key
     filenames = {filenames[0]: [filenames[1]]}
 
-    def _map_filenames(imgs):
-        """
-        Return CuipImageArray for a given parition
-        """
-        img_list = [imgtup for imgtup in imgs]
-        fn_mapped = []
-        for img in img_list:
-            fn_mapped.append(zip(repeat(img[0]),
-                                 filelist[os.path.basename(img[0]).strip('.raw')],
-                                 img[1]))
-        yield fn_mapped
     try:
         if sc:
-            imgrdd = sc.binaryFiles(os.path.join(fpath, fname))
-            img_byte = imgrdd.map(lambda (x,y): (x, (np.asarray(bytearray(y), dtype=np.uint8))))
-            img_res  = imgrdd.mapValues(lambda x: _reshape(x, combined, nrows, ncols, ndims))
-            return img_res.mapPartitions(_map_filenames)
-            return img_res.map(lambda x: zip(filenames, x[1]))
+            return _fromrecords(sc, [os.path.join(fpath, fname)], filenames,
+                                nrows, ncols, nwavs, dtype)
+        elif asbatch:
+            return _tobatch([os.path.join(fpath, fname)], filenames, nrows,
+                            ncols, nwavs, nstack, dtype, mmap)
         else:
             # read raw images and add to a tuple with fpath
             img = (os.path.join(fpath,fname), 
-                    np.fromfile(os.path.join(fpath, fname), dtype).\
-                        reshape(nstack, nrows, ncols, nwavs))
+                   _readstack(os.path.join(fpath, fname), nrows, ncols,
+                              nwavs, nstack, dtype, mmap=mmap))
             # create list of fname and gname mapped images 
             fn_mapped = zip(repeat(img[0]), 
                             filenames[os.path.basename(img[0]).strip('.raw')],
@@ -85,7 +227,8 @@ def fromfile(fpath, fname, nrows, ncols, nwavs, filenames, nstack, dtype, sc):
     except Exception as ex:
         logger.error("Error loading file: "+str(ex))
 
-def fromflist(flist, nrows, ncols, nwavs, filenames, nstack, dtype, sc):
+def fromflist(flist, nrows, ncols, nwavs, filenames, nstack, dtype, sc,
+              mmap=False, asbatch=False):
     """
     Read files from a list as a binary file if sc is passed
     else return a list of tuple with filename and the binary
@@ -108,39 +251,38 @@ def fromflist(flist, nrows, ncols, nwavs, filenames, nstack, dtype, sc):
     sc: sparkContext
         if calling the function in spark cluster, this
         function will return a RDD of all files
+    mmap: bool, optional
+        if True, the subimages will be views into read-only
+        `np.memmap`s of the files instead of being read
+        into memory (ignored if sc is passed)
+    asbatch: bool, optional
+        if True, return a single FrameBatch holding all
+        the subimages instead of a list of CuipImageArray
+        (ignored if sc is passed)
 
     Returns
     -------
     if sc:
-        return RDD which will be in format ()
+        return RDD of CuipImageArray, one per subimage
+    elif asbatch:
+        return FrameBatch
     else:
-        return list of 
+        return list of CuipImageArray
     """
     # create dictionary of filenames with f_range as key
     filenames = dict((f_rng, fnames) for f_rng,fnames in filenames)
 
-    def _map_filenames(imgs):
-        """
-        Return CuipImageArray for a given parition
-        """
-        img_list = [imgtup for imgtup in imgs]
-        fn_mapped = []
-        for img in img_list:
-            fn_mapped.append(zip(repeat(img[0]),
-                                 filelist[os.path.basename(img[0]).strip('.raw')],
-                                 img[1]))
-        yield fn_mapped
-
     try:
         if sc:
-            imgrdd   = sc.binaryFiles(",".join(flist))
-            img_tup  = imgrdd.map(lambda (x,y): (x, (np.asarray(bytearray(y), dtype=np.uint8))))
-            img_res  = imgrdd.mapValues(lambda x: _reshape(x, combined, nrows, ncols, ndims))
-            return img_res.mapPartitions(_map_filenames)
+            return _fromrecords(sc, flist, filenames, nrows, ncols, nwavs,
+                                dtype)
+        elif asbatch:
+            return _tobatch(flist, filenames, nrows, ncols, nwavs, nstack,
+                            dtype, mmap)
         else:
             # create a list of all the files as a tuple of fname and ndarray
-            img_list = [(fpath, np.fromfile(fpath, dtype).\
-                             reshape(nstack, nrows, ncols, nwavs))\
+            img_list = [(fpath, _readstack(fpath, nrows, ncols, nwavs,
+                                           nstack, dtype, mmap=mmap))\
                             for fpath in flist]
             fn_mapped = []
             # create list of fname and gname mapped images
@@ -156,3 +298,80 @@ def fromflist(flist, nrows, ncols, nwavs, filenames, nstack, dtype, sc):
             
     except Exception as ex:
         logger.error("Error processing flist: "+str(ex))
+
+def _stack_key(fpath):
+    """
+    Return the first file number of a stacked file
+    named as `<first fnumber>_<last fnumber>.raw`
+    """
+    try:
+        return int(os.path.basename(fpath).split('_')[0])
+    except ValueError:
+        return fpath
+
+def iterflist(flist, nrows, ncols, nwavs, filenames, nstack, dtype,
+              bufsize=16, mmap=False):
+    """
+    Generator yielding the subimages from a list of stacked
+    files one at a time, ordered by file number (and hence
+    timestamp).
+    At most `bufsize` subimages are held in memory at once.
+
+    Parameters
+    ----------
+    flist: list
+        list of files to be read from
+    nrows, ncols, nwavs: int
+        shape of the image
+    filenames: 1-d array or list of `list of filenames`
+        list of tuples of (f_range, list of filenames)
+        as passed to `fromflist`
+    nstack: int
+        number of subimages in each file
+    dtype: data type of the image
+        default: np.uint8
+    bufsize: int, optional
+        number of subimages to read from disk at once
+    mmap: bool, optional
+        if True, yield views into read-only `np.memmap`s
+        of the files instead of reading them in chunks
+
+    Returns
+    -------
+    `Generator` of CuipImageArray with metadata containing
+    gname and fname
+    """
+    # create dictionary of filenames with f_range as key
+    filenames = dict((f_rng, fnames) for f_rng,fnames in filenames)
+    imgsize   = nrows * ncols * nwavs
+    bufsize   = max(1, min(bufsize, nstack))
+
+    for fpath in sorted(flist, key=_stack_key):
+        try:
+            fnames = filenames[os.path.basename(fpath).strip(".raw")]
+        except KeyError:
+            logger.error("No filenames found for "+str(fpath))
+            continue
+
+        nimg = min(nstack, len(fnames))
+        if mmap:
+            stack = _readstack(fpath, nrows, ncols, nwavs, nstack, dtype,
+                               mmap=True)
+            for fname, img in zip(fnames[:nimg], stack):
+                yield cia.CuipImageArray(img_array=img,
+                                         metadata={"gname": fpath,
+                                                   "fname": fname})
+            continue
+
+        try:
+            with open(fpath, "rb") as fh:
+                for first in range(0, nimg, bufsize):
+                    count = min(bufsize, nimg - first)
+                    buf   = np.fromfile(fh, dtype, count=count*imgsize)
+                    buf   = _reshape(buf, nrows, ncols, nwavs, nstack=count)
+                    for fname, img in zip(fnames[first:first+count], buf):
+                        yield cia.CuipImageArray(img_array=img,
+                                                 metadata={"gname": fpath,
+                                                           "fname": fname})
+        except (IOError, TypeError) as ex:
+            logger.error("Error reading "+str(fpath)+": "+str(ex))
@@ -0,0 +1,135 @@
+import os
+import numpy as np
+import cia
+from cuip.cuip.utils import cuiplogger
+
+logger = cuiplogger.cuipLogger(loggername="MANIFEST", tofile=False)
+
+# -- extension of the manifest written next to each stacked file
+MANIFEST_EXT   = ".mft"
+
+# -- one record per subimage of the stacked file
+MANIFEST_DTYPE = np.dtype([("fnumber", np.int64),
+                           ("timestamp", "datetime64[s]"),
+                           ("offset", np.int64)])
+
+def manifest_name(stackname):
+    """
+    Return the file name of the manifest of a stacked file
+    """
+    return stackname + MANIFEST_EXT
+
+def write_manifest(stackname, fnumbers, timestamps, framesize):
+    """
+    Write the manifest of a stacked file, containing the file
+    number, timestamp and byte offset of every subimage.
+
+    Parameters
+    ----------
+    stackname: str
+        absolute path of the stacked file
+    fnumbers: 1-d array or list
+        file numbers of the subimages, in stacking order
+    timestamps: 1-d array or list
+        timestamps of the subimages (None if unknown)
+    framesize: int
+        size of a subimage in bytes
+    """
+    mft = np.zeros(len(fnumbers), dtype=MANIFEST_DTYPE)
+    mft["fnumber"]   = fnumbers
+    mft["timestamp"] = [np.datetime64("NaT") if t is None else
+                        np.datetime64(t, "s") for t in timestamps]
+    mft["offset"]    = np.arange(len(fnumbers)) * framesize
+
+    # -- write to a temporary file so that readers never see
+    #    a partial manifest
+    fname = manifest_name(stackname)
+    with open(fname+".tmp", "wb") as fh:
+        np.save(fh, mft)
+    os.rename(fname+".tmp", fname)
+
+def read_manifest(stackname, mmap=False):
+    """
+    Return the manifest of a stacked file as a numpy
+    structured array (see `MANIFEST_DTYPE`)
+    """
+    return np.load(manifest_name(stackname), mmap_mode="r" if mmap else None)
+
+# -- sorted (first, last, fname) index of the stacked files of each
+#    directory, keyed by (dpath, ext), with the directory mtime
+_stack_index = {}
+
+def stack_index(dpath, ext=".raw"):
+    """
+    Return the first and last fnumbers (sorted by first fnumber)
+    and the file names of the stacked files in `dpath`.  The
+    directory is only listed again when its mtime changes.
+    """
+    key   = (os.path.abspath(dpath), ext)
+    mtime = os.stat(dpath).st_mtime
+    if key in _stack_index and _stack_index[key][0] == mtime:
+        return _stack_index[key][1]
+
+    ranges = []
+    for fname in os.listdir(dpath):
+        if not fname.endswith(ext):
+            continue
+        try:
+            first, last = [int(i) for i in fname[:-len(ext)].split("_")]
+        except ValueError:
+            continue
+        ranges.append((first, last, fname))
+    ranges.sort()
+
+    index = (np.array([rng[0] for rng in ranges], dtype=np.int64),
+             np.array([rng[1] for rng in ranges], dtype=np.int64),
+             [rng[2] for rng in ranges])
+    _stack_index[key] = (mtime, index)
+    return index
+
+def find_stack(dpath, fnumber, ext=".raw"):
+    """
+    Return the stacked file in `dpath` whose
+    `<first fnumber>_<last fnumber>` range contains fnumber
+    (None if not found)
+    """
+    firsts, lasts, fnames = stack_index(dpath, ext=ext)
+    idx = np.searchsorted(firsts, fnumber, side="right") - 1
+    if idx >= 0 and fnumber <= lasts[idx]:
+        return os.path.join(dpath, fnames[idx])
+
+def read_frame(stackname, fnumber, nrows, ncols, nwavs, dtype=np.uint8):
+    """
+    Read a single source frame out of a stacked file by
+    seeking to its offset given by the manifest.
+
+    Parameters
+    ----------
+    stackname: str
+        absolute path of the stacked file
+    fnumber: int
+        file number of the source frame
+    nrows, ncols, nwavs: int
+        shape of the subimages
+    dtype: data type of the image
+
+    Returns
+    -------
+    CuipImageArray with metadata containing gname, fnumber and
+    timestamp (None if fnumber is not in the stack)
+    """
+    mft = read_manifest(stackname)
+    idx = np.flatnonzero(mft["fnumber"] == fnumber)
+    if len(idx) == 0:
+        logger.error("fnumber "+str(fnumber)+" not found in "+str(stackname))
+        return None
+    rec = mft[idx[0]]
+
+    with open(stackname, "rb") as fh:
+        fh.seek(int(rec["offset"]))
+        img = np.fromfile(fh, dtype, count=nrows*ncols*nwavs) \
+            .reshape(nrows, ncols, nwavs)
+    return cia.CuipImageArray(img_array=img,
+                              metadata={"gname": stackname,
+                                        "fnumber": int(rec["fnumber"]),
+                                        "timestamp": rec["timestamp"]})
@@ -0,0 +1,96 @@
+import time
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from cuip.cuip.utils import cuiplogger
+
+logger = cuiplogger.cuipLogger(loggername="PREFETCH", tofile=False)
+
+class PrefetchReader(object):
+    """
+    Iterate over the decoded contents of a list of files
+    while the next `depth` files are being read in the
+    background by a pool of worker threads.
+    Files are returned in the same order as `flist`.
+
+    Example
+    -------
+    >>> reader = PrefetchReader(flist, read_raw, depth=4)
+    >>> for fname, img in reader:
+    ...     process(img)
+    >>> reader.stall
+    """
+
+    def __init__(self, flist, reader, depth=4, nthreads=2):
+        """
+        Parameters
+        ----------
+        flist: list
+            list of files (or any arguments accepted by `reader`)
+        reader: callable
+            function that reads and decodes a single file.
+            example: `cuip.cuip.registration.uo_tools.read_raw`
+        depth: int
+            number of files to read ahead of the one currently
+            being processed
+        nthreads: int
+            number of worker threads reading files
+        """
+        self.flist    = flist
+        self.reader   = reader
+        self.depth    = max(1, depth)
+        self.nthreads = max(1, nthreads)
+        # -- time spent waiting for a file that was not yet read
+        self.stall    = 0.0
+        self.nstall   = 0
+
+    def _read(self, fname):
+        """
+        Read a file, returning the exception instead of
+        raising it in the worker thread
+        """
+        try:
+            return self.reader(fname), None
+        except Exception as ex:
+            return None, ex
+
+    def __len__(self):
+        return len(self.flist)
+
+    def __iter__(self):
+        pool    = ThreadPool(self.nthreads)
+        pending = deque()
+        files   = iter(self.flist)
+        self.stall  = 0.0
+        self.nstall = 0
+        try:
+            # -- fill the readahead queue
+            for fname in files:
+                pending.append((fname, pool.apply_async(self._read, (fname,))))
+                if len(pending) >= self.depth:
+                    break
+
+            while pending:
+                fname, res = pending.popleft()
+
+                # -- keep the queue `depth` files ahead of the consumer
+                for nfname in files:
+                    pending.append((nfname,
+                                    pool.apply_async(self._read, (nfname,))))
+                    break
+
+                if not res.ready():
+                    t0 = time.time()
+                    res.wait()
+                    self.stall  += time.time() - t0
+                    self.nstall += 1
+
+                img, ex = res.get()
+                if ex is not None:
+                    logger.error("Error reading "+str(fname)+": "+str(ex))
+                yield fname, img
+        finally:
+            pool.terminate()
+            pool.join()
+            logger.debug("Stalled {0} times for {1:.2f}s reading {2} files" \
+                             .format(self.nstall, self.stall,
+                                     len(self.flist)))
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare the run time of the spark (HadoopImageCluster) and local
+(LocalImageCluster) backends on the combined binned archive.
+
+    python bench_backends.py <local dir> [<hdfs dir>]
+"""
+
+import os
+import sys
+import time
+import numpy as np
+from cuip.cuip.hadoop.local import LocalImageCluster
+
+if __name__ == "__main__":
+
+    # -- combined archive as written by combine.py
+    locpath  = sys.argv[1]
+    hdfspath = sys.argv[2] if len(sys.argv) > 2 else None
+    file_ext = ".raw"
+    binfac   = 8
+    nrows    = 2160 // binfac
+    ncols    = 4096 // binfac
+    ndims    = 3
+    combined = 4 * binfac * binfac
+
+    # -- local backend
+    t0  = time.time()
+    lic = LocalImageCluster(path=locpath, fname_ext=file_ext, n=combined,
+                            rows=nrows, cols=ncols, dims=ndims)
+    ldf = lic.stats(nsig=5, bin=1)
+    tloc = time.time() - t0
+    print("local: {0} images from {1} files in {2:.1f}s ({3} processes)" \
+              .format(len(ldf), len(lic.sources), tloc, lic.nproc))
+
+    if hdfspath is None:
+        sys.exit()
+
+    # -- spark backend
+    from cuip.cuip.hadoop.hic import HadoopImageCluster
+
+    t0  = time.time()
+    hic = HadoopImageCluster(sc=None, path=hdfspath, fname=None,
+                             fname_ext=file_ext, n=combined, rows=nrows,
+                             cols=ncols, dims=ndims)
+    hdf = hic.stats(nsig=5, bin=1).toPandas()
+    tspk = time.time() - t0
+    print("spark: {0} images in {1:.1f}s".format(len(hdf), tspk))
+
+    # -- check that the backends agree
+    if len(hdf) == len(ldf):
+        dbright = np.abs(hdf.bright.values - ldf.bright.values).max()
+        print("max bright pixel difference: {0}".format(dbright))
+    print("speedup of local backend: {0:.2f}x".format(tspk / tloc))
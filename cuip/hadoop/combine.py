@@ -6,15 +6,44 @@ import multiprocessing
 import numpy as np
 from datetime import datetime
 from itertools import izip_longest
+from multiprocessing import util
+from multiprocessing.pool import ThreadPool
 from scipy.ndimage import imread
 from cuip.cuip.utils import cuiplogger
 from cuip.cuip.database.add_files import UpdateTask, ToCSV
 from cuip.cuip.database.db_tables import ToFilesDB
 from cuip.cuip.database.database_worker import Worker
 from cuip.cuip.utils.misc import get_files, _get_files
+from cuip.cuip.fileio.manifest import write_manifest
 
 logger = cuiplogger.cuipLogger(loggername="COMBINE", tofile=False)
 
+# -- define the function for reading a single image
+def decode(tfile, binfac, nrow=2160, ncol=4096, nwav=3):
+    """
+    Read a png or raw image (as a tuple of (path, fnumber))
+    and return it binned by binfac. Return None if the file
+    format is not supported.
+    """
+    ext = tfile[0][-3:].lower()
+    if ext == 'png':
+        return imread(tfile[0], mode="RGB")[::binfac, ::binfac]
+    elif ext == 'raw':
+        return np.fromfile(tfile[0], dtype=np.uint8) \
+            .reshape(nrow, ncol, nwav)[::binfac, ::binfac, ::-1]
+    else:
+        logger.error("File format not supported "+\
+                         str(tfile[0]) + "fnumber: "+\
+                         str(tfile[1]))
+
+def stack_name(dpath, tflist):
+    """
+    Return the file name of the stacked image for a group of
+    files: `<first fnumber>_<last fnumber>.raw`
+    """
+    return os.path.join(dpath, "_".join([str(tflist[0][1]),
+                                         str(tflist[-1][1])])+str(".raw"))
+
 # -- define the function for stacking images
 def merge_subset(conn, sublist, dpath, binfac, nimg_per_file, nrow=2160, 
                  ncol=4096, nwav=3, verbose=False):
@@ -29,17 +58,9 @@ def merge_subset(conn, sublist, dpath, binfac, nimg_per_file, nrow=2160,
         filenumbers = []
         for ii,tfile in enumerate(tflist):
             filenumbers.append(str(tfile[1]))
-            ext = tfile[0][-3:].lower()
-            if ext == 'png':
-                img_out[dr*ii:dr*(ii+1)] = imread(tfile[0], mode="RGB") \
-                    [::binfac, ::binfac]
-            elif ext == 'raw':
-                img_out[dr*ii:dr*(ii+1)] = np.fromfile(tfile[0], dtype=np.uint8) \
-                    .reshape(nrow, ncol, nwav)[::binfac, ::binfac, ::-1]
-            else:
-                logger.error("File format not supported "+\
-                                 str(tfile[0]) + "fnumber: "+\
-                                 str(tfile[1]))
+            img = decode(tfile, binfac, nrow, ncol, nwav)
+            if img is not None:
+                img_out[dr*ii:dr*(ii+1)] = img
         #newfname = os.path.join(dpath, "{0}.raw".format(gid))
         newfname = os.path.join(dpath, "_".join([filenumbers[0], 
                                                  filenumbers[-1]])+str(".raw"))
@@ -49,6 +70,144 @@ def merge_subset(conn, sublist, dpath, binfac, nimg_per_file, nrow=2160,
     conn.close()
     return 
 
+# -- per process state of the stacking workers
+_stacker = {}
+
+def _init_stacker(dpath, binfac, nimg_per_file, nrow, ncol, nwav, nthreads):
+    """
+    Initialize a stacking worker process with two output buffers,
+    a pool of threads decoding images and a thread writing the
+    stacked images to disk
+    """
+    dr = nrow//binfac
+    dc = ncol//binfac
+    _stacker.update(dpath=dpath, binfac=binfac, nrow=nrow, ncol=ncol,
+                    nwav=nwav, dr=dr,
+                    bufs=[np.zeros([nimg_per_file*dr, dc, nwav], 
+                                   dtype=np.uint8) for i in range(2)],
+                    pending=[None, None], current=0,
+                    decoder=ThreadPool(nthreads), writer=ThreadPool(1))
+    # -- make sure that the last write completes before the worker exits
+    #    (the finalizers of the thread pools run at exitpriority=15 and
+    #    drop their pending tasks, so this has to run first)
+    util.Finalize(None, _flush_stacker, exitpriority=20)
+
+def _flush_stacker():
+    """
+    Wait for the pending writes of a stacking worker
+    """
+    for res in _stacker.get("pending", []):
+        if res is not None:
+            res.wait()
+
+def _write_stack(img_out, newfname, tflist, framesize):
+    """
+    Write the stacked image to a temporary file and rename it
+    so that only complete stacks carry the final file name.
+    The manifest mapping the subimages to their source files
+    is written first.
+    """
+    try:
+        write_manifest(newfname, [tfile[1] for tfile in tflist],
+                       [tfile[2] if len(tfile) > 2 else None 
+                        for tfile in tflist], framesize)
+        img_out.tofile(newfname+".tmp")
+        os.rename(newfname+".tmp", newfname)
+        logger.info("Wrote filename: "+str(newfname))
+    except (IOError, OSError) as ex:
+        logger.error("Error writing "+str(newfname)+": "+str(ex))
+
+def _stack_group(group):
+    """
+    Decode a group of files in parallel into the free output
+    buffer and write it asynchronously
+    """
+    gid, tflist = group
+    st  = _stacker
+    dr  = st["dr"]
+    cur = st["current"]
+    st["current"] = 1 - cur
+
+    # -- wait until the buffer has been written out
+    if st["pending"][cur] is not None:
+        st["pending"][cur].wait()
+    img_out = st["bufs"][cur]
+
+    def _fill(ii):
+        img = decode(tflist[ii], st["binfac"], st["nrow"], st["ncol"],
+                     st["nwav"])
+        img_out[dr*ii:dr*(ii+1)] = 0 if img is None else img
+
+    st["decoder"].map(_fill, range(len(tflist)))
+    img_out[dr*len(tflist):] = 0
+
+    newfname = stack_name(st["dpath"], tflist)
+    st["pending"][cur] = st["writer"].apply_async(_write_stack,
+                                                  (img_out, newfname, tflist,
+                                                   img_out[:dr].nbytes))
+    return gid, newfname
+
+def is_complete(fname, nbytes):
+    """
+    Return True if the stacked file exists and is complete
+    """
+    return os.path.isfile(fname) and os.path.getsize(fname) == nbytes
+
+def stack_groups(flist_out, dpath, binfac, nimg_per_file, nproc=10, 
+                 nthreads=4, nrow=2160, ncol=4096, nwav=3):
+    """
+    Merge each group of files into a stacked image and write it
+    to disk. Groups are handed out one at a time to `nproc`
+    worker processes, each decoding `nthreads` images at once
+    while the previous stack is being written.
+    Stacks that already exist and are complete are skipped so
+    that an interrupted run can be resumed.
+
+    Parameters
+    ----------
+    flist_out: dict
+        key = group id and value = list of (path, fnumber, timestamp)
+        in that group
+    dpath: str
+        output directory
+    binfac: int
+        factor to bin the images by
+    nimg_per_file: int
+        number of images per stacked file
+    nproc: int
+        number of worker processes
+    nthreads: int
+        number of decoding threads per worker process
+
+    Returns
+    -------
+    list of the stacked file names written
+    """
+    nbytes = nimg_per_file * (nrow//binfac) * (ncol//binfac) * nwav
+    todo   = [(gid, tflist) for gid, tflist in sorted(flist_out.items())
+              if len(tflist) > 0 and 
+              not is_complete(stack_name(dpath, tflist), nbytes)]
+    logger.info("Skipping {0} complete stacks, {1} left to write" \
+                    .format(len(flist_out) - len(todo), len(todo)))
+
+    pool = multiprocessing.Pool(nproc, initializer=_init_stacker,
+                                initargs=(dpath, binfac, nimg_per_file, nrow,
+                                          ncol, nwav, nthreads))
+    written = []
+    try:
+        for gid, newfname in pool.imap_unordered(_stack_group, todo,
+                                                  chunksize=1):
+            written.append(newfname)
+    finally:
+        pool.close()
+        pool.join()
+
+    # -- check that all the writes completed
+    nfail = sum(not is_complete(fname, nbytes) for fname in written)
+    if nfail:
+        logger.error("{0} stacks were not written completely".format(nfail))
+    return written
+
 if __name__ == "__main__":
 
     inpath  = os.getenv("CUIP_2013")
@@ -67,7 +226,7 @@ if __name__ == "__main__":
 
     # -- get all the files between st and en
     if f_dbname:
-        logger.info("Fetching file locations from database. This will return fname, fpath and fnumber")
+        logger.info("Fetching file locations from database. This will return fname, fpath, fnumber and timestamp")
         file_list = get_files(f_dbname, st, en)
     else:
         logger.warning("Database not found. Process continue by scanning filesystem")
@@ -95,14 +254,6 @@ if __name__ == "__main__":
     nproc = 10
     logger.info("Creating %s worker processes"%(nproc))
 
-    # -- set the number of files per processor
-    if nproc == 1:
-        nout_per_proc = nout 
-    elif nout % nproc == 0:
-        nout_per_proc = nout//nproc
-    else:
-        nout_per_proc = nout//nproc + 1
-
     # -- alert the user
     logger.info("combining {0} input files into {1} output files." \
                     .format(nin,nout))
@@ -138,24 +289,6 @@ if __name__ == "__main__":
 
     _poison_workers(tasks)
 
-    # -- initialize workers and execute
-    parents, childs, ps = [], [], []
-    result = []
-    groups_per_proc = [flist_out.keys()[i::nproc] for i in range(nproc)]
+    # -- stack the images (skipping the stacks already written)
     logger.info("Starting stacking process")
-    for ip in range(nproc):
-        ptemp, ctemp = multiprocessing.Pipe()
-        parents.append(ptemp)
-        childs.append(ctemp)
-        ps.append(multiprocessing.Process(target=merge_subset, 
-                                          args=(childs[ip], {gid: flist_out[gid] 
-                                                             for gid \
-                                                                 in groups_per_proc[ip]},
-                                                outpath, binfac, nimg_per_file), 
-                                          kwargs={"verbose":True}))
-
-        ps[ip].start()
-        childs[ip].close()
-
-    # -- Join all processes
-    dum = [ps[ip].join() for ip in range(nproc)]
+    stack_groups(flist_out, outpath, binfac, nimg_per_file, nproc=nproc)
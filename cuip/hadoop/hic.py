@@ -8,9 +8,10 @@ import matplotlib.pyplot as plt
 import os
 from pyspark import SparkConf, SparkContext
 from pyspark.sql import SQLContext
-from pyspark.sql.types import StructType, StructField, StringType, DoubleType
+from pyspark.sql.types import StructType, StructField, StringType, DoubleType, LongType
 import numpy as np
 from itertools import chain
+from cuip.cuip.hadoop import imgstats
 
 APP_NAME = "Hadoop_Image_Cluster"
 
@@ -18,7 +19,7 @@ class HadoopImageCluster(object):
     """
     Hadoop Image Cluster
     """
-    def __init__(self, sc, path=None, fname=None, fname_ext=None, n=4, rows=2160, cols=4096, dims=3):
+    def __init__(self, sc, path=None, fname=None, fname_ext=None, n=4, rows=2160, cols=4096, dims=3, batch=None):
         """
         Parameters
         ----------
@@ -39,6 +40,9 @@ class HadoopImageCluster(object):
             number of columns (per stacked array)
         ndims: int
             `ndims` dimensions
+        batch: `cuip.cuip.fileio.FrameBatch`, optional
+            if passed, the images are taken from the batch
+            (in groups of `n`) instead of being read from `path`
 
         Returns:
             img_rdd: rdd dataset containing images as numpy arrays
@@ -66,13 +70,16 @@ class HadoopImageCluster(object):
         self.cols = cols
         self.dims = dims
 
-        self.img_rdd = self._getImgRDD(self.path, 
-                                       self.fname, 
-                                       self.fname_ext,
-                                       n = self.n,
-                                       nrows = self.rows,
-                                       ncols = self.cols,
-                                       ndims = self.dims)
+        if batch is not None:
+            self.img_rdd = self._getBatchRDD(batch, n = self.n)
+        else:
+            self.img_rdd = self._getImgRDD(self.path, 
+                                           self.fname, 
+                                           self.fname_ext,
+                                           n = self.n,
+                                           nrows = self.rows,
+                                           ncols = self.cols,
+                                           ndims = self.dims)
         #self.img_rdd.persist()
 
 
@@ -112,18 +119,37 @@ class HadoopImageCluster(object):
                                           minPartitions=100)
         
         def _reshape(x):
-            return [x[i*img_size: (i+1)*img_size].\
-                        reshape(nrows, ncols, ndims) \
-                        for i in range(n)]
+            # -- x[k] is the k-th image in the stack
+            return x[:n*img_size].reshape(n, nrows, ncols, ndims)
     
-        rdd = imgpair.map(lambda (x,y): (x, (np.asarray(bytearray(y), 
-                                                        dtype=np.uint8))))
+        # -- zero copy view of the file contents
+        rdd = imgpair.mapValues(lambda y: np.frombuffer(y, dtype=np.uint8))
         
         rdd_resh = rdd.mapValues(_reshape)
 
         return rdd_resh
 
 
+    def _getBatchRDD(self, batch, n):
+        """
+        Return rdd of the images in a FrameBatch grouped
+        in stacks of `n`, keyed as `<first fnumber>_<last fnumber>.raw`
+        (or by position in the batch if the file numbers are unknown)
+        Parameters
+        ----------
+        batch: `cuip.cuip.fileio.FrameBatch`
+            batch of images of shape (N, nrows, ncols, ndims)
+        n: int
+            number of images per stack
+        """
+        fnums = batch.fnumbers.copy()
+        fnums[fnums < 0] = np.arange(len(batch))[fnums < 0]
+
+        stacks = [("{0}_{1}.raw".format(fnums[i], fnums[min(i+n, len(batch))-1]),
+                   batch.data[i:i+n]) for i in range(0, len(batch), n)]
+
+        return self.sc.parallelize(stacks, max(1, len(stacks)))
+
     def mean(self, n, bin, asdf=True):
         """
         Return the mean of the n-dim numpy array
@@ -196,20 +222,44 @@ class HadoopImageCluster(object):
             df = self.sqlcontext.createDataFrame(std_formatted, schema)
             return df
 
-    def getBright(self, n, bin):
+    def getBright(self, n, bin, asdf=True):
         """
         Find the pixels brighter than 5 sigma
         Parameters
         ----------
         n: int
             n for n*sigma outlier
-        bin: int
-            factor to bin the image by
+        bin: int or list of int
+            factor(s) to bin the image by.
+            If a list is passed, all the bin factors are computed
+            from a single read of the images and the result is
+            a table with one `bright_bin<b>` column per factor
+        asdf: bool
+            (only used if bin is a list)
+            True: return the output as a dataframe sorted by fnumber
+            False: return the output as RDD of numpy structured
+                arrays (one per stack)
         .. note: Seriously need to come up with better names
         """
+        if isinstance(bin, (list, tuple)):
+            bright_rdd = self.img_rdd.map(lambda x: \
+                                              imgstats.stack_bright(x[1],
+                                                                    imgstats.first_fnumber(x[0]),
+                                                                    nsig=n,
+                                                                    bins=bin))
+            if not asdf:
+                return bright_rdd
+            dtype  = imgstats.bright_dtype(sorted(set(bin)))
+            schema = StructType([StructField(name, LongType(), True)
+                                 for name in dtype.names])
+            df = self.sqlcontext.createDataFrame(bright_rdd.flatMap(lambda x: \
+                                                                        x.tolist()),
+                                                 schema)
+            return df.orderBy("fnumber")
+
         def _getbright(x):
             result = []
-            for k in range(combined):
+            for k in range(len(x)):
                 result.append((x[k][::bin,::bin] > \
                                    (x[k][::bin,::bin].mean(axis=(0,1))+ \
                                         n*(x[k][::bin,::bin].std()))).\
@@ -219,11 +269,71 @@ class HadoopImageCluster(object):
         bright = self.img_rdd.mapValues(_getbright)
         return bright
 
+    def stats(self, nsig=5, bin=1, asdf=True):
+        """
+        Return the per channel mean, std, min and max, the std
+        across all channels and the number of pixels brighter
+        than `nsig` sigma for every image, computed in a single
+        pass over each stack.
+        Parameters
+        ----------
+        nsig: int
+            n for n*sigma outlier
+        bin: int
+            factor to bin the image by
+        asdf: bool
+            True: return the output as a dataframe with one
+                row per image, sorted by fnumber
+            False: return the output as RDD of numpy structured
+                arrays (one per stack)
+        """
+        stats_rdd = self.img_rdd.map(lambda x: \
+                                         imgstats.stack_stats(x[1], 
+                                                              imgstats.first_fnumber(x[0]),
+                                                              nsig=nsig,
+                                                              bin=bin))
+
+        if not asdf:
+            return stats_rdd
+        else:
+            dtype  = imgstats.stats_dtype(self.dims)
+            schema = StructType([StructField(name, LongType() \
+                                                 if dtype[name].kind == "i" \
+                                                 else DoubleType(), True)
+                                 for name in dtype.names])
+            df = self.sqlcontext.createDataFrame(stats_rdd.flatMap(lambda x: \
+                                                                       x.tolist()),
+                                                 schema)
+            return df.orderBy("fnumber")
+
+    def saveAsNpy(self, rdd, outpath):
+        """
+        Write an RDD of numpy structured arrays (as returned by
+        `stats(asdf=False)` or `getBright(n, [bins], asdf=False)`)
+        as one typed `part-<index>.npy` file per partition.
+        Load the result with `imgstats.load_parts(outpath)`.
+        Parameters
+        ----------
+        rdd: RDD of numpy structured arrays
+        outpath: str
+            output directory. This must be on a filesystem shared
+            by all the executors (e.g. GPFS), not hdfs. The
+            `part-*.npy` files of a previous run are removed
+        """
+        if not os.path.isdir(outpath):
+            os.makedirs(outpath)
+        imgstats.remove_parts(outpath)
+        return rdd.mapPartitionsWithIndex(lambda i, x: \
+                                              [imgstats.save_partition(x, 
+                                                                       outpath, 
+                                                                       i)]).\
+                                                                       collect()
+
 if __name__ == "__main__":
 #    f_path = '/user/mohitsharma44/uo_images/bad_combined'
 #    f_path = '/home/cusp/gdobler/cuip/cuip/hadoop/output/combined_images'
     inpath   = '/user/mohitsharma44/input/combined_bin8/'
-    outpath  = '/user/mohitsharma44/output/'
+    outpath  = '/home/cusp/mohitsharma44/output/'
     file_ext = ".raw"
     binfac   = 8
     nrows    = 2160 // binfac
@@ -243,8 +353,5 @@ if __name__ == "__main__":
     #df.show(truncate = False)
     # Obtain Std dev
     #std = hic.std(combined, nrows=rows, ncols=cols, ndims=dims, asdf=False)
-    res = hic.getBright(5, 1)
-    def toStr(data):
-        return ','.join(str(d) for d in data)
-    out = res.map(toStr)
-    out.saveAsTextFile(os.path.join(outpath, "dataplot.txt_bin_8"))
+    res = hic.getBright(5, [1, 2, 4], asdf=False)
+    hic.saveAsNpy(res, os.path.join(outpath, "dataplot_bright"))
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Numpy kernels computing image statistics for stacks of images
+of shape (n, nrows, ncols, ndims). These do not depend on spark
+so that they can be used by any execution backend.
+"""
+
+import os
+import numpy as np
+
+# -- number of pixel values processed at once (bounds the
+#    temporary arrays to a few tens of MB)
+CHUNK_SIZE = 2**24
+
+def first_fnumber(fpath):
+    """
+    Return the first file number of a stacked file named
+    as `<first fnumber>_<last fnumber>.raw`
+    """
+    return int(os.path.basename(fpath).split("_")[0])
+
+def stats_dtype(ndims=3):
+    """
+    Return the numpy structured dtype of the statistics
+    returned by `stack_stats`
+    """
+    fields = [("fnumber", np.int64)]
+    for stat in ["mean", "std", "min", "max"]:
+        fields += [("{0}_ch{1}".format(stat, ch), np.float64)
+                   for ch in range(ndims)]
+    fields += [("std", np.float64), ("bright", np.int64)]
+    return np.dtype(fields)
+
+def _chunks(stack):
+    """
+    Return the number of images to process at once
+    """
+    return max(1, CHUNK_SIZE // max(1, stack[0].size))
+
+def stack_stats(stack, fnumber=0, nsig=5, bin=1):
+    """
+    Return the per channel mean, standard deviation, minimum
+    and maximum, the standard deviation across all channels and
+    the number of bright pixels of each image in a stack.
+    All statistics are computed in a single pass over the pixels
+    (vectorized over the images in the stack).
+
+    A pixel is bright if any of its channels is brighter than
+    the channel mean plus `nsig` times the standard deviation
+    across all channels (as in `HadoopImageCluster.getBright`).
+
+    Parameters
+    ----------
+    stack: np.ndarray
+        uint8 array of shape (n, nrows, ncols, ndims)
+    fnumber: int
+        file number of the first image in the stack
+    nsig: float
+        n for n*sigma outlier
+    bin: int
+        factor to bin the image by
+
+    Returns
+    -------
+    numpy structured array (see `stats_dtype`) of length n
+    """
+    nimg  = len(stack)
+    ndims = stack.shape[-1]
+    res   = np.zeros(nimg, dtype=stats_dtype(ndims))
+    res["fnumber"] = fnumber + np.arange(nimg)
+    step  = _chunks(stack[:, ::bin, ::bin])
+
+    for first in range(0, nimg, step):
+        sub = stack[first:first+step, ::bin, ::bin]
+        npx = float(sub.shape[1] * sub.shape[2])
+
+        # -- sums and sums of squares are exact in integer arithmetic
+        s1  = sub.sum(axis=(1, 2), dtype=np.uint64).astype(np.float64)
+        s2  = np.square(sub, dtype=np.uint16) \
+            .sum(axis=(1, 2), dtype=np.uint64).astype(np.float64)
+        avg = s1 / npx
+        sig = np.sqrt(np.maximum(s2 / npx - avg**2, 0.))
+        gsig = np.sqrt(np.maximum(s2.sum(1) / (npx * ndims) -
+                                  (s1.sum(1) / (npx * ndims))**2, 0.))
+        thr = avg + nsig * gsig[:, np.newaxis]
+
+        out = res[first:first+step]
+        for ch in range(ndims):
+            out["mean_ch{0}".format(ch)] = avg[:, ch]
+            out["std_ch{0}".format(ch)]  = sig[:, ch]
+        mins = sub.min(axis=(1, 2))
+        maxs = sub.max(axis=(1, 2))
+        for ch in range(ndims):
+            out["min_ch{0}".format(ch)] = mins[:, ch]
+            out["max_ch{0}".format(ch)] = maxs[:, ch]
+        out["std"]    = gsig
+        out["bright"] = (sub > thr[:, np.newaxis, np.newaxis, :]) \
+            .any(-1).sum(axis=(1, 2))
+
+    return res
+
+def bright_dtype(bins):
+    """
+    Return the numpy structured dtype of the bright pixel
+    counts returned by `stack_bright`
+    """
+    return np.dtype([("fnumber", np.int64)] +
+                    [("bright_bin{0}".format(b), np.int64) for b in bins])
+
+def stack_bright(stack, fnumber=0, nsig=5, bins=(1, 2, 4, 8)):
+    """
+    Return the number of bright pixels of each image in a
+    stack at several bin factors.
+    The stack is read once: every bin factor is obtained by
+    subsampling the next finer level already in memory.
+
+    Parameters
+    ----------
+    stack: np.ndarray
+        uint8 array of shape (n, nrows, ncols, ndims)
+    fnumber: int
+        file number of the first image in the stack
+    nsig: float
+        n for n*sigma outlier
+    bins: list
+        factors to bin the image by
+
+    Returns
+    -------
+    numpy structured array (see `bright_dtype`) of length n
+    """
+    bins  = sorted(set(bins))
+    res   = np.zeros(len(stack), dtype=bright_dtype(bins))
+    res["fnumber"] = fnumber + np.arange(len(stack))
+
+    level, lbin = stack, 1
+    for b in bins:
+        # -- coarser levels are views of the finer ones
+        if b % lbin == 0:
+            level = level[:, ::b // lbin, ::b // lbin]
+        else:
+            level = stack[:, ::b, ::b]
+        lbin  = b
+        res["bright_bin{0}".format(b)] = stack_stats(level, fnumber,
+                                                     nsig=nsig)["bright"]
+
+    return res
+
+def _part_files(path):
+    """
+    Return the sorted `part-*.npy` file names in path
+    """
+    return [fname for fname in sorted(os.listdir(path))
+            if fname.startswith("part-") and fname.endswith(".npy")]
+
+def remove_parts(path):
+    """
+    Remove the `part-*.npy` files of a previous run from path so
+    that `load_parts` does not mix them with the new ones.
+    """
+    for fname in _part_files(path):
+        os.remove(os.path.join(path, fname))
+
+def save_partition(arrs, outpath, index):
+    """
+    Write a list of numpy structured arrays (e.g. the outputs of
+    `stack_stats` for one partition) as a single npy file
+    `part-<index>.npy` in outpath. Return the file name.
+    """
+    arrs = list(arrs)
+    if len(arrs) == 0:
+        return None
+    fname = os.path.join(outpath, "part-{0:05}.npy".format(index))
+    np.save(fname, np.concatenate(arrs))
+    return fname
+
+def load_parts(path, key="fnumber"):
+    """
+    Memory map all the `part-*.npy` files in path and return
+    their concatenation sorted by `key`.
+    """
+    parts = [np.load(os.path.join(path, fname), mmap_mode="r")
+             for fname in _part_files(path)]
+    if len(parts) == 0:
+        return None
+    arr = np.concatenate(parts)
+    return arr[np.argsort(arr[key], kind="mergesort")]
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import glob
+import multiprocessing
+import numpy as np
+import pandas as pd
+from cuip.cuip.utils import cuiplogger
+from cuip.cuip.hadoop import imgstats
+
+logger = cuiplogger.cuipLogger(loggername="LIC", tofile=False)
+
+# -- frame buffer of a FrameBatch, set before the worker processes are
+#    forked so that they share its pages with the parent
+_BATCH = None
+
+def _getstack(source, n, nrows, ncols, ndims):
+    """
+    Return the stack of images (n, nrows, ncols, ndims) for
+    a file path or a (first, last) range of the shared batch
+    """
+    if isinstance(source, tuple):
+        return _BATCH.data[source[0]:source[1]]
+    # -- read only memory map; the pages are shared through the
+    #    page cache by all the processes reading the same file
+    return np.memmap(source, dtype=np.uint8, mode="r") \
+        [:n*nrows*ncols*ndims].reshape(n, nrows, ncols, ndims)
+
+def _stack_stats(args):
+    """
+    Worker function returning the statistics of one stack.
+    If `bin` is a list, return the bright pixel counts for
+    each bin factor instead
+    """
+    key, source, fnumber, n, nrows, ncols, ndims, nsig, bin = args
+    try:
+        stack = _getstack(source, n, nrows, ncols, ndims)
+        if isinstance(bin, (list, tuple)):
+            return key, imgstats.stack_bright(stack, fnumber, nsig=nsig,
+                                              bins=bin)
+        return key, imgstats.stack_stats(stack, fnumber, nsig=nsig, bin=bin)
+    except Exception as ex:
+        logger.error("Error processing "+str(key)+": "+str(ex))
+        if isinstance(bin, (list, tuple)):
+            return key, np.zeros(0, dtype=imgstats.bright_dtype(sorted(set(bin))))
+        return key, np.zeros(0, dtype=imgstats.stats_dtype(ndims))
+
+class LocalImageCluster(object):
+    """
+    Local (spark free) counterpart of `HadoopImageCluster`
+    which processes the stacked images with a pool of
+    processes on a single node and returns pandas DataFrames.
+    """
+    def __init__(self, path=None, fname=None, fname_ext=None, n=4, rows=2160, cols=4096, dims=3, batch=None, nproc=None):
+        """
+        Parameters
+        ----------
+        path: str
+            Location in the filesystem containing files
+        fname: str, optional
+            filename to be processed
+        fname_ext: str
+            extension for binary filenames
+        n: int
+            if arrays are vertically stacked, n is the
+            total number of stacked arrays
+        rows: int
+            number of rows (per stacked array)
+        cols: int
+            number of columns (per stacked array)
+        dims: int
+            `dims` dimensions
+        batch: `cuip.cuip.fileio.FrameBatch`, optional
+            if passed, the images are taken from the batch
+            (in groups of `n`) instead of being read from `path`
+        nproc: int, optional
+            number of worker processes (default: number of cpus)
+        """
+        self.path      = path
+        self.fname     = fname
+        self.fname_ext = fname_ext
+        self.n         = n
+        self.rows      = rows
+        self.cols      = cols
+        self.dims      = dims
+        self.batch     = batch
+        self.nproc     = nproc or multiprocessing.cpu_count()
+
+        if batch is not None:
+            fnums = batch.fnumbers.copy()
+            fnums[fnums < 0] = np.arange(len(batch))[fnums < 0]
+            self.sources = [("{0}_{1}.raw".format(fnums[i],
+                                                  fnums[min(i+n, len(batch))-1]),
+                             (i, i+n), fnums[i])
+                            for i in range(0, len(batch), n)]
+        else:
+            if fname:
+                flist = [os.path.join(path, fname)]
+            else:
+                flist = sorted(glob.glob(os.path.join(path, "*"+fname_ext)))
+            self.sources = [(f, f, imgstats.first_fnumber(f)) for f in flist]
+
+    def _map(self, nsig, bin):
+        """
+        Return a list of (key, statistics) for all the stacks
+        """
+        global _BATCH
+        _BATCH = self.batch
+        args   = [(key, source, fnumber, self.n, self.rows, self.cols,
+                   self.dims, nsig, bin)
+                  for key, source, fnumber in self.sources]
+        pool   = multiprocessing.Pool(self.nproc)
+        try:
+            return pool.map(_stack_stats, args, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+            _BATCH = None
+
+    def stats(self, nsig=5, bin=1, asdf=True):
+        """
+        Return the per channel mean, std, min and max, the std
+        across all channels and the number of pixels brighter
+        than `nsig` sigma for every image (see `HadoopImageCluster.stats`)
+        Parameters
+        ----------
+        nsig: int
+            n for n*sigma outlier
+        bin: int
+            factor to bin the image by
+        asdf: bool
+            True: return a pandas DataFrame with one row per
+                image sorted by fnumber
+            False: return a list of (filename, numpy structured array)
+        """
+        res = self._map(nsig, bin)
+        if not asdf:
+            return res
+        return self._todf(res)
+
+    @staticmethod
+    def _todf(res):
+        """
+        Return a list of (filename, numpy structured array) as
+        a pandas DataFrame sorted by fnumber
+        """
+        df = pd.DataFrame(np.concatenate([x[1] for x in res]))
+        df.insert(0, "Filename", np.concatenate([[os.path.basename(x[0])] *
+                                                 len(x[1]) for x in res]))
+        return df.sort_values(by="fnumber").reset_index(drop=True)
+
+    def mean(self, n, bin, asdf=True):
+        """
+        Return the per channel mean of every image
+        n: int
+            if arrays are vertically stacked, n is the
+            total number of stacked arrays
+        bin: int
+            factor to bin the image by
+        asdf: bool
+            True: return the output as a pandas DataFrame
+            False: return a list of (filename, list of means)
+        """
+        df  = self.stats(bin=bin)
+        chs = ["mean_ch{0}".format(ch) for ch in range(self.dims)]
+        if not asdf:
+            return [(fname, grp[chs].values[:n].tolist())
+                    for fname, grp in df.groupby("Filename", sort=False)]
+        return df[["Filename", "fnumber"] + chs] \
+            .rename(columns=dict(zip(chs, ["CH{0}".format(ch) for ch
+                                           in range(self.dims)])))
+
+    def std(self, n, bin, asdf=True):
+        """
+        Return the standard deviation of every image
+        Parameters
+        ----------
+        n: int
+            if arrays are vertically stacked, n is the
+            total number of stacked arrays
+        bin: int
+            factor to bin the image by
+        asdf: bool
+            True: return the output as a pandas DataFrame
+            False: return a list of (filename, list of stds)
+        """
+        df = self.stats(bin=bin)
+        if not asdf:
+            return [(fname, grp["std"].values[:n].tolist())
+                    for fname, grp in df.groupby("Filename", sort=False)]
+        return df[["Filename", "fnumber", "std"]] \
+            .rename(columns={"std": "STD"})
+
+    def getBright(self, n, bin, asdf=True):
+        """
+        Find the pixels brighter than 5 sigma
+        Parameters
+        ----------
+        n: int
+            n for n*sigma outlier
+        bin: int or list of int
+            factor(s) to bin the image by.
+            If a list is passed, all the bin factors are computed
+            from a single read of the images and the result has
+            one `bright_bin<b>` column per factor
+        asdf: bool
+            (only used if bin is a list)
+            True: return a pandas DataFrame sorted by fnumber
+            False: return a list of (filename, numpy structured array)
+        """
+        if isinstance(bin, (list, tuple)):
+            res = self._map(n, list(bin))
+            return self._todf(res) if asdf else res
+
+        df = self.stats(nsig=n, bin=bin)
+        return df[["Filename", "fnumber", "bright"]]
@@ -4,12 +4,24 @@ import os
 import numpy as np
 import matplotlib.pyplot as plt
 from operator import itemgetter
+from cuip.cuip.hadoop.imgstats import load_parts
 
 path_nobin = '/home/cusp/mohitsharma44/dataplot_nobin/'
 path_2bin = '/home/cusp/mohitsharma44/dataplot_bin_2/'
 path_4bin = '/home/cusp/mohitsharma44/dataplot_bin_4/'
 path_8bin = '/home/cusp/mohitsharma44/dataplot_bin_8/'
 
+def getArrays(path):
+    """
+    Return (fnumber, {binfac: number of bright pixels scaled by binfac^2})
+    from the npy partitions written by HadoopImageCluster.saveAsNpy
+    """
+    res  = load_parts(path)
+    bins = [int(name[len("bright_bin"):]) for name in res.dtype.names
+            if name.startswith("bright_bin")]
+    return res["fnumber"], dict((b, b*b*res["bright_bin{0}".format(b)])
+                                for b in bins)
+
 def getPoints(path, binfac):
     files = [os.path.join(path, x) for x in os.listdir(path) if x.startswith('part')]
     all_points = []
@@ -28,10 +40,27 @@ def getPoints(path, binfac):
     all_points = sorted(map(lambda x: sorted(x.items()), all_points))
     return [x for y in all_points for x in y]
 
-all_points_nobin = getPoints(path_nobin, 1)
-all_points_2bin  = getPoints(path_2bin, 2)
-all_points_4bin  = getPoints(path_4bin, 4)
-all_points_8bin  = getPoints(path_8bin, 8)
+path_bright = '/home/cusp/mohitsharma44/output/dataplot_bright/'
+
+fig = plt.figure()
+ax = fig.add_subplot(111)
+
+if os.path.isdir(path_bright):
+    # -- all bin factors in a single table
+    fnumber, bright = getArrays(path_bright)
+    for b in sorted(bright):
+        ax.plot(fnumber, bright[b], label="bin_x{0}".format(b))
+else:
+    # -- text output of separate runs
+    all_points_nobin = getPoints(path_nobin, 1)
+    all_points_2bin  = getPoints(path_2bin, 2)
+    all_points_4bin  = getPoints(path_4bin, 4)
+    all_points_8bin  = getPoints(path_8bin, 8)
+
+    ax.plot(*zip(*all_points_nobin), label="no_bin")
+    ax.plot(*zip(*all_points_2bin),  label="bin_x2")
+    ax.plot(*zip(*all_points_4bin), label="bin_x4")
+    ax.plot(*zip(*all_points_8bin), label="bin_x8")
 
 #points_nobin = np.hstack([x.values() for x in all_points_nobin])
 #points_2bin  = np.hstack([x.values() for x in all_points_2bin])
@@ -43,14 +72,6 @@ all_points_8bin  = getPoints(path_8bin, 8)
 #point_array_4bin = np.asarray(points_4bin, dtype=np.int).flatten()
 #point_array_8bin = np.asarray(points_8bin, dtype=np.int).flatten()
 
-fig = plt.figure()
-ax = fig.add_subplot(111)
-
-ax.plot(*zip(*all_points_nobin), label="no_bin")
-ax.plot(*zip(*all_points_2bin),  label="bin_x2")
-ax.plot(*zip(*all_points_4bin), label="bin_x4")
-ax.plot(*zip(*all_points_8bin), label="bin_x8")
-
 #ax.plot(range(points_nobin.shape[1]), points_nobin[0][:points_nobin.shape[1]], label="no_bin")
 #ax.plot(range(points_2bin.shape[1]),  points_2bin[0][:points_2bin.shape[1]]*4, label="bin x2")
 #ax.plot(range(points_4bin.shape[1]),  points_4bin[0][:points_4bin.shape[1]]*16, label="bin x4")
@@ -8,6 +8,7 @@ import numpy as np
 import pandas as pd
 import scipy.ndimage.measurements as ndm
 from cuip.cuip.registration.uo_tools import read_raw
+from cuip.cuip.fileio.prefetch import PrefetchReader
 
 if __name__ == "__main__":
 
@@ -61,21 +62,23 @@ if __name__ == "__main__":
     rot      = np.zeros_like(labs[0])
     
     
-    # -- read in image
-    for ii in range(nobs):
+    # -- read in the registered images ahead of processing
+    good   = np.arange(nobs)[(reg.drow != -9999).values]
+    flist  = [os.path.join(reg.iloc[ii].fpath, reg.iloc[ii].fname) 
+              for ii in good]
+    reader = PrefetchReader(flist, read_raw, depth=4)
+
+    for jj, (fname, img) in enumerate(reader):
+        ii = good[jj]
     
         if ii % 10 == 0:
             lopen.write("  obs {0} of {1}\n".format(ii, nobs))
             lopen.flush()
     
-        if reg.iloc[ii].drow == -9999:
-            continue
-    
         rot[...] = 0.
         rec      = reg.iloc[ii]
         ct       = np.cos(-rec.dtheta * deg2rad)
         st       = np.sin(-rec.dtheta * deg2rad)
-        img      = read_raw(rec.fpath, rec.fname)
     
         # -- rotate the source labels (the nrow//2 and ncol//2 performs
         #    rotation about the center of the image)
@@ -103,6 +106,7 @@ if __name__ == "__main__":
     lopen.write("\nWriting to npy...\n========\n")
     lopen.flush()
     np.save(oname, lcs)
+    lopen.write("waited {0}s on file reads\n".format(reader.stall))
     lopen.write("FINISHED in {0}s\n".format(time.time() - t0))
     lopen.flush()
     lopen.close()
@@ -1,4 +1,8 @@
 from register_block import *
+from register_batch import *
 from register import *
+from phasecorr import *
+from warp import *
+from catalog import *
 from source_match import *
 from test_bright import *
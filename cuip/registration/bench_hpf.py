@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare the run time and results of uo_tools.high_pass_filter and the
+float32 luminosity uo_tools.HighPassFilter (at full resolution and
+binned) on a list of raw frames.
+
+    python bench_hpf.py <raw file> [<raw file> ...]
+"""
+
+import sys
+import time
+import numpy as np
+import uo_tools as ut
+from register import locate_sources
+
+if __name__ == "__main__":
+
+    # -- filters to compare
+    sigma   = 10
+    filters = [("high_pass_filter", lambda img: ut.high_pass_filter(img,
+                                                                 sigma)
+                .mean(-1)),
+               ("HighPassFilter", ut.HighPassFilter(sigma)),
+               ("HighPassFilter binfac=2", ut.HighPassFilter(sigma, 2)),
+               ("HighPassFilter binfac=4", ut.HighPassFilter(sigma, 4))]
+    times   = np.zeros(len(filters))
+    diffs   = np.zeros(len(filters))
+    nsrc    = np.zeros(len(filters), dtype=int)
+
+    for fname in sys.argv[1:]:
+        img = ut.read_raw(fname)
+        ref = None
+        for ii, (name, hpf) in enumerate(filters):
+            t0        = time.time()
+            hpL       = hpf(img)
+            times[ii] += time.time() - t0
+            if ref is None:
+                ref = hpL.copy()
+            diffs[ii] = max(diffs[ii], np.abs(hpL - ref).max())
+            nsrc[ii] += locate_sources(img, hpf=hpf).shape[1]
+
+    # -- report
+    nfr = len(sys.argv[1:])
+    for (name, hpf), tt, dd, ns in zip(filters, times, diffs, nsrc):
+        print("{0:25}: {1:.3f}s per frame, max |difference| {2:.3f}, " \
+                  "{3} sources".format(name, tt / nfr, dd, ns))
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare the run time and results of the catalog (register.register)
+and phase correlation (phasecorr.PhaseCorrRegistration) registration
+of a list of raw frames.
+
+    python bench_phasecorr.py <raw file> [<raw file> ...]
+
+The reference image of the phase correlation is the reference image
+of the catalog (register.get_reference_image).
+"""
+
+import sys
+import time
+import numpy as np
+import uo_tools as ut
+from register import register, get_reference_image
+from phasecorr import PhaseCorrRegistration
+
+if __name__ == "__main__":
+
+    # -- read the frames
+    flist = sys.argv[1:]
+    imgs  = np.array([ut.read_raw(fname) for fname in flist])
+
+    # -- catalog registration
+    t0 = time.time()
+    cat = []
+    for img in imgs:
+        try:
+            cat.append(register(img))
+        except Exception:
+            cat.append([-9999, -9999, -9999])
+    cat  = np.array(cat, dtype=float)
+    tcat = time.time() - t0
+
+    # -- phase correlation registration (one batch)
+    t0  = time.time()
+    pcr = PhaseCorrRegistration(get_reference_image())
+    tref = time.time() - t0
+    t0  = time.time()
+    pcs = pcr.register_batch(imgs)
+    tpc = time.time() - t0
+
+    # -- compare
+    for fname, p0, p1, pk in zip(flist, cat, pcs, pcr.peak):
+        print("{0}: catalog {1:8.2f} {2:8.2f} {3:6.3f}   " \
+                  "phasecorr {4:8.2f} {5:8.2f} {6:6.3f} (peak {7:.2f})" \
+                  .format(fname, p0[0], p0[1], p0[2], p1[0], p1[1], p1[2],
+                          pk))
+
+    good = cat[:, 0] != -9999
+    print("catalog:   {0:.3f}s per frame ({1} failures)" \
+              .format(tcat / len(imgs), (~good).sum()))
+    print("phasecorr: {0:.3f}s per frame (+{1:.1f}s for the reference)" \
+              .format(tpc / len(imgs), tref))
+    if good.any():
+        diff = np.abs(cat[good] - pcs[good])
+        print("mean |difference| (drow, dcol, dtheta): {0}" \
+                  .format(diff.mean(0)))
+        print("max  |difference| (drow, dcol, dtheta): {0}" \
+                  .format(diff.max(0)))
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Build, save and load registration catalogs.
+
+A catalog artifact is an npz file holding the row/col positions of the
+catalog sources together with the invariants used by register
+(pairwise distance matrix and the angle between the first two pairs),
+so that they are not recomputed for every frame.
+
+    python catalog.py <reference raw file> <output npz> [seed catalog]
+
+derives the catalog from a reference frame by re-centroiding the
+sources of the seed catalog (default "dobler2015_alt2") in that frame.
+"""
+
+import os
+import sys
+import numpy as np
+from cuip.cuip.utils import cuiplogger
+
+logger = cuiplogger.cuipLogger(loggername="CATALOG", tofile=False)
+
+# -- extension of catalog artifacts
+CATALOG_EXT = ".npz"
+
+# -- catalogs loaded in this process
+_catalogs = {}
+
+def catalog_invariants(rr_cat, cc_cat):
+    """
+    Return the pairwise distance matrix of the catalog sources and
+    the angle (degrees) between the 0-1 and 0-2 pairs.
+    """
+    dcatm = np.sqrt((rr_cat[:, np.newaxis] - rr_cat)**2 +
+                    (cc_cat[:,np.newaxis] - cc_cat)**2)
+
+    theta01_cat = np.arccos((rr_cat[0] - rr_cat[1]) / dcatm[0, 1])
+    theta02_cat = np.arccos((rr_cat[0] - rr_cat[2]) / dcatm[0, 2])
+    dtheta_cat  = (theta01_cat - theta02_cat) * 180. / np.pi
+
+    return dcatm, dtheta_cat
+
+
+def save_catalog(fname, rr_cat, cc_cat, source=""):
+    """
+    Write a catalog artifact with the positions of the sources and
+    their invariants.
+
+    Parameters
+    ----------
+    fname: str
+        output file name (npz)
+    rr_cat, cc_cat: np.ndarray
+        row/col positions of the catalog sources
+    source: str
+        frame the catalog was derived from
+    """
+    dcatm, dtheta_cat = catalog_invariants(rr_cat, cc_cat)
+    with open(fname + ".tmp", "wb") as fopen:
+        np.savez(fopen, rr_cat=rr_cat, cc_cat=cc_cat, dcatm=dcatm,
+                 dtheta_cat=dtheta_cat, source=source)
+    os.rename(fname + ".tmp", fname)
+
+
+def load_catalog(fname):
+    """
+    Return a catalog artifact as a dict of rr_cat, cc_cat, dcatm,
+    dtheta_cat and source.  Each file is read once per process.
+    """
+    fname = os.path.abspath(fname)
+    if fname not in _catalogs:
+        with np.load(fname) as cat:
+            _catalogs[fname] = {key: cat[key] for key in cat.files}
+        _catalogs[fname]["dtheta_cat"] = float(_catalogs[fname]["dtheta_cat"])
+        _catalogs[fname]["source"]     = str(_catalogs[fname]["source"])
+
+    return _catalogs[fname]
+
+
+def build_catalog(img, seed="dobler2015_alt2", tol=10., **kwargs):
+    """
+    Derive the catalog from a reference frame.
+
+    The frame is registered to the seed catalog and each seed source
+    is replaced by the centroid of the nearest source detected in the
+    frame (within tol pixels of its predicted position).
+
+    Parameters
+    ----------
+    img: np.ndarray
+        reference frame (nrow, ncol, nwav)
+    seed: str
+        name or artifact of the catalog used to identify the sources
+    tol: float
+        maximum distance (pixels) between the predicted and detected
+        positions of a source
+    **kwargs:
+        passed to register.locate_sources
+
+    Returns
+    -------
+    rr_cat, cc_cat: np.ndarray
+        row/col positions of the catalog sources in the frame
+    """
+    import register as reg
+
+    # -- register the frame to the seed catalog and predict the
+    #    positions of the seed sources
+    tracker  = reg.RegistrationTracker(ref=seed)
+    tracker.register(img)
+    rrp, ccp = tracker.predict(img.shape)
+
+    # -- match to the detected sources
+    rr1, cc1 = reg.locate_sources(img, **kwargs)
+    dist     = np.sqrt((rrp[:, np.newaxis] - rr1)**2 +
+                       (ccp[:, np.newaxis] - cc1)**2)
+    ind      = dist.argmin(1)
+    miss     = dist[np.arange(len(rrp)), ind] > tol
+    if miss.any():
+        raise ValueError("catalog sources {0} not found in the reference "
+                         "frame".format(np.flatnonzero(miss).tolist()))
+
+    return rr1[ind], cc1[ind]
+
+
+if __name__ == "__main__":
+
+    import uo_tools as ut
+
+    # -- build the catalog from the reference frame
+    infile = sys.argv[1]
+    oname  = sys.argv[2]
+    seed   = sys.argv[3] if len(sys.argv) > 3 else "dobler2015_alt2"
+    rr_cat, cc_cat = build_catalog(ut.read_raw(infile), seed=seed)
+
+    # -- write the artifact
+    save_catalog(oname, rr_cat, cc_cat, source=infile)
+    logger.info("wrote {0} sources from {1} to {2}".format(len(rr_cat),
+                                                           infile, oname))
@@ -6,6 +6,7 @@ import numpy as np
 import pandas as pd
 import uo_tools as ut
 import matplotlib.pyplot as plt
+from register_qa import read_registrations
 
 def view_images(imgs, fac=4, wait=1e-3):
     plt.close("all")
@@ -83,19 +84,9 @@ def view_flist(flist, fac=4, wait=1e-3):
 
 
 # -- read in the data
-#for ii in range(10):
-#    if ii == 0:
-for ii in range(10,20):
-    if ii == 10:
-        data = pd.read_csv(os.path.join("output", 
-                                        "register_{0:04}.csv".format(ii)), 
-                           parse_dates=["timestamp"])
-    else:
-        data = data.append(pd.read_csv(os.path.join("output", 
-                                                    "register_{0:04}.csv" \
-                                                        .format(ii)), 
-                                       parse_dates=["timestamp"]))
-data.reset_index(inplace=True)
+data = read_registrations([os.path.join("output", "register_{0:04}.csv" \
+                                            .format(ii)) 
+                           for ii in range(10, 20)])
 nbad = (np.abs(data.drow) > 20).sum()
 nnon = (np.abs(data.drow) == 9999).sum()
 print("{0}".format(ii))
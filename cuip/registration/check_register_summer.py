@@ -6,8 +6,9 @@ import numpy as np
 import pandas as pd
 import uo_tools as ut
 import matplotlib.pyplot as plt
+from register_qa import read_registrations, read_thumb
 
-def view_images(imgs, fac=4, wait=1e-3):
+def view_images(imgs, fac=1, wait=1e-3):
     plt.close("all")
 
     xs = 8.0
@@ -32,16 +33,9 @@ def view_images(imgs, fac=4, wait=1e-3):
 
 
 # -- read in the data
-for ii in range(10, 20):
-    if ii == 10:
-        data = pd.read_csv(os.path.join("output", 
-                                        "register_{0:04}.csv".format(ii)), 
-                           parse_dates=["timestamp"])
-    else:
-        data = data.append(pd.read_csv(os.path.join("output", 
-                                                    "register_{0:04}.csv" \
-                                                        .format(ii)), 
-                                       parse_dates=["timestamp"]))
+data = read_registrations([os.path.join("output", "register_{0:04}.csv" \
+                                            .format(ii)) 
+                           for ii in range(10, 20)])
 nbad = (np.abs(data.drow) > 200).sum()
 nnon = (np.abs(data.drow) == 9999).sum()
 print("{0}".format(ii))
@@ -53,9 +47,9 @@ print("fraction not registered {0}\n".format(nnon / float(len(data))))
 bind = data.drow == -9999
 bad  = data[bind]
 ex   = bad[-100:]
-imgs = [ut.read_raw(os.path.join(i.fpath, i.fname)) for r, i in ex.iterrows()]
+imgs = [read_thumb(os.path.join(i.fpath, i.fname)) for r, i in ex.iterrows()]
 
 np.random.seed(314)
 rind = np.random.rand(len(bad)).argsort()[:100]
 rx   = bad.iloc[rind].sort_values(by="timestamp")
-imgr = [ut.read_raw(os.path.join(i.fpath, i.fname)) for r, i in rx.iterrows()]
+imgr = [read_thumb(os.path.join(i.fpath, i.fname)) for r, i in rx.iterrows()]
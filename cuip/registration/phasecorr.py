@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Registration of frames to a reference image by FFT phase correlation.
+
+The rotation is found by phase correlating the log-polar transforms
+of the Fourier magnitudes (which do not depend on the translation),
+and the translation by phase correlating the de-rotated binned
+luminosity images.  All the steps operate on stacks of frames so
+that a batch of frames is registered with a few FFTs.
+
+Unlike register.register this does not rely on detecting the catalog
+sources, but it returns the parameters in the same (-dr, -dc, -dtheta)
+convention relative to the reference image.
+"""
+
+import numpy as np
+import scipy.ndimage as nd
+
+def bin_luminosity(imgs, binfac=4):
+    """
+    Return the luminosity of a frame (nrow, ncol, nwav) or stack of
+    frames (nimg, nrow, ncol, nwav) binned by binfac as float32.
+    """
+    imgs = np.asarray(imgs)
+    one  = imgs.ndim == 3
+    if one:
+        imgs = imgs[np.newaxis]
+    nimg, nrow, ncol, nwav = imgs.shape
+    nr, nc = nrow // binfac, ncol // binfac
+    lum    = imgs[:, :nr*binfac, :nc*binfac] \
+        .reshape(nimg, nr, binfac, nc, binfac, nwav) \
+        .sum(axis=(2, 4, 5), dtype=np.float32) / float(binfac**2 * nwav)
+
+    return lum[0] if one else lum
+
+
+def _hann(shape):
+    """
+    Return a 2D Hann window.
+    """
+    return np.outer(np.hanning(shape[0]), np.hanning(shape[1])) \
+        .astype(np.float32)
+
+
+def _peak(corr):
+    """
+    Return the sub-pixel (row, col) peak positions and heights of a
+    stack of (circular) correlation surfaces (nimg, nr, nc).  Shifts
+    larger than half the size wrap to negative values.
+    """
+    nimg, nr, nc = corr.shape
+    flat = corr.reshape(nimg, -1).argmax(1)
+    pr   = flat // nc
+    pc   = flat % nc
+    img  = np.arange(nimg)
+    y0   = corr[img, pr, pc]
+
+    # -- parabolic interpolation along each axis
+    def _sub(ym, yp):
+        den = ym - 2 * y0 + yp
+        with np.errstate(invalid="ignore", divide="ignore"):
+            off = np.where(den != 0, 0.5 * (ym - yp) / den, 0.)
+        return np.clip(off, -0.5, 0.5)
+
+    dr = pr + _sub(corr[img, (pr - 1) % nr, pc], corr[img, (pr + 1) % nr, pc])
+    dc = pc + _sub(corr[img, pr, (pc - 1) % nc], corr[img, pr, (pc + 1) % nc])
+    dr = np.where(dr > nr / 2., dr - nr, dr)
+    dc = np.where(dc > nc / 2., dc - nc, dc)
+
+    return dr, dc, y0
+
+
+def phase_correlate(fref, fimg, shape):
+    """
+    Return the shifts (dr, dc) such that img(x) = ref(x - d) and the
+    correlation peak heights, given the real FFTs (np.fft.rfft2) of
+    the reference and of a stack of images of the given shape.
+    """
+    cross  = fimg * np.conj(fref)
+    cross /= np.abs(cross) + 1e-12
+
+    return _peak(np.fft.irfft2(cross, s=shape))
+
+
+class PhaseCorrRegistration(object):
+    """
+    Register frames to a reference image by FFT phase correlation.
+
+    Parameters
+    ----------
+    ref: np.ndarray
+        reference image (nrow, ncol, nwav), e.g.
+        register.get_reference_image()
+    binfac: int
+        factor to bin the luminosity images by
+    nang: int
+        number of angles of the log-polar transform over 180 degrees
+    nrad: int
+        number of radii of the log-polar transform
+    nrefine: int
+        number of iterations of the refinement of the rotation
+    """
+
+    def __init__(self, ref, binfac=4, nang=720, nrad=256, nrefine=2):
+        self.binfac  = binfac
+        self.nrefine = nrefine
+        self.shape  = ref.shape[:2]
+        self.nang   = nang
+        self.nrad   = nrad
+
+        # -- binned reference, its window and FFT
+        lum         = bin_luminosity(ref, binfac)
+        self.bshape = lum.shape
+        self.win    = _hann(self.bshape)
+        self.fref   = np.fft.rfft2(self._prep(lum[np.newaxis]))[0]
+
+        # -- center of rotation (register uses nrow//2, ncol//2) in
+        #    binned pixels
+        self.center = [(self.shape[ii] // 2 - (binfac - 1) / 2.) / binfac
+                       for ii in (0, 1)]
+
+        # -- the rotation is measured on the central square of the
+        #    binned image so that the frequency axes are isotropic
+        nsq          = min(self.bshape)
+        self.square  = (slice((self.bshape[0] - nsq) // 2,
+                              (self.bshape[0] + nsq) // 2),
+                        slice((self.bshape[1] - nsq) // 2,
+                              (self.bshape[1] + nsq) // 2))
+        self.swin    = _hann((nsq, nsq))
+        self.lpcoord = self._logpolar_coords(nsq)
+        self.flpref  = np.fft.rfft2(self._logpolar(lum[np.newaxis]))[0]
+
+        # -- binned pixel positions relative to the center of rotation
+        rr, cc    = np.mgrid[:self.bshape[0], :self.bshape[1]]
+        self.grid = (rr - self.center[0], cc - self.center[1])
+
+        self.peak = None
+
+    def _prep(self, lum):
+        """
+        Return mean subtracted and windowed luminosity images.
+        """
+        lum = lum - lum.mean(axis=(1, 2), keepdims=True)
+        return lum * self.win
+
+    def _logpolar_coords(self, nsq):
+        """
+        Return the (row, col) coordinates of the log-polar samples of
+        a centered (nsq, nsq) spectrum.
+        """
+        theta = np.arange(self.nang) * np.pi / self.nang
+        rad   = np.exp(np.linspace(np.log(2.), np.log(nsq / 2. - 1),
+                                   self.nrad))
+        return np.array([nsq // 2 + rad * np.cos(theta[:, np.newaxis]),
+                         nsq // 2 + rad * np.sin(theta[:, np.newaxis])])
+
+    def _logpolar(self, lum):
+        """
+        Return the log-polar transforms (nimg, nang, nrad) of the
+        high-pass filtered Fourier magnitudes of the central squares
+        of a stack of luminosity images.
+        """
+        sq  = lum[(slice(None),) + self.square]
+        sq  = (sq - sq.mean(axis=(1, 2), keepdims=True)) * self.swin
+        mag = np.fft.fftshift(np.abs(np.fft.fft2(sq)), axes=(1, 2))
+
+        # -- suppress the lowest frequencies
+        nsq = sq.shape[1]
+        kk  = np.cos(np.pi * (np.arange(nsq) - nsq // 2) / float(nsq))
+        mag = np.log1p(mag) * (1. - np.outer(kk, kk))
+
+        return np.array([nd.map_coordinates(mm, self.lpcoord, order=1)
+                         for mm in mag])
+
+    def _translate(self, lum, dtheta):
+        """
+        Return the offsets (dr, dc) in full resolution pixels and the
+        correlation peak heights of a stack of mean subtracted
+        luminosity images given their rotations (radians).
+        """
+        nimg    = lum.shape[0]
+        cs, sn  = np.cos(dtheta)[:, np.newaxis, np.newaxis], \
+            np.sin(dtheta)[:, np.newaxis, np.newaxis]
+        rr, cc  = self.grid
+
+        # -- de-rotate the frames about the center of rotation
+        coords  = np.array([np.broadcast_to(np.arange(nimg)[:, np.newaxis,
+                                                            np.newaxis],
+                                            (nimg,) + rr.shape),
+                            cs * rr - sn * cc + self.center[0],
+                            sn * rr + cs * cc + self.center[1]])
+        derot   = nd.map_coordinates(lum, coords, order=1, cval=0.)
+
+        # -- translation of the de-rotated frames, rotated back
+        sr, sc, peak = phase_correlate(self.fref,
+                                       np.fft.rfft2(derot * self.win),
+                                       self.bshape)
+        cs, sn = cs[:, 0, 0], sn[:, 0, 0]
+
+        return (cs * sr - sn * sc) * self.binfac, \
+            (sn * sr + cs * sc) * self.binfac, peak
+
+    def register_batch(self, imgs):
+        """
+        Register a stack of frames (nimg, nrow, ncol, nwav) to the
+        reference image.  Returns an array (nimg, 3) of
+        (-dr, -dc, -dtheta) as in register.register.  The correlation
+        peak heights of the translation are stored in self.peak.
+        """
+        lum  = bin_luminosity(imgs, self.binfac)
+        if lum.ndim == 2:
+            lum = lum[np.newaxis]
+        nimg = lum.shape[0]
+
+        # -- rotation from the log-polar Fourier magnitudes
+        flp        = np.fft.rfft2(self._logpolar(lum))
+        dang, _, _ = phase_correlate(self.flpref, flp, 
+                                     (self.nang, self.nrad))
+        dtheta     = dang * np.pi / self.nang
+
+        # -- refine the rotation by maximizing the translation
+        #    correlation peak over the neighbouring angles (with a
+        #    smaller step at each iteration) and interpolate the
+        #    translation to the refined rotation
+        lum  = lum - lum.mean(axis=(1, 2), keepdims=True)
+        step = np.pi / self.nang
+        for _ in range(self.nrefine):
+            trns = np.array([self._translate(lum, dtheta + ii * step)
+                             for ii in (-1, 0, 1)])
+            den  = trns[0, 2] - 2 * trns[1, 2] + trns[2, 2]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                off = np.where(den < 0, 0.5 * (trns[0, 2] - trns[2, 2]) /
+                               den, 0.)
+            off     = np.clip(off, -1, 1)
+            dtheta += off * step
+            step   /= 4.
+        dr, dc, self.peak = trns[1] + 0.5 * off * (trns[2] - trns[0]) + \
+            0.5 * off**2 * (trns[2] - 2 * trns[1] + trns[0])
+
+        return np.array([-dr, -dc, -dtheta * 180. / np.pi]).T
+
+    def register(self, img):
+        """
+        Register a single frame to the reference image (same output
+        as register.register).
+        """
+        return tuple(self.register_batch(img[np.newaxis])[0])
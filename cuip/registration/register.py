@@ -7,16 +7,23 @@ import numpy as np
 import matplotlib.pyplot as plt
 import scipy.ndimage as nd
 import scipy.ndimage.measurements as spm
+from scipy.spatial import cKDTree
 import uo_tools as ut
+from warp import warp
+from catalog import CATALOG_EXT, load_catalog, catalog_invariants
 from cuip.cuip.utils.misc import get_files
 
 def locate_sources(img, hpf=False):
     """
-    Extract sources from an image.
+    Extract sources from an image.  hpf can be a uo_tools.HighPassFilter 
+    that returns the high pass filtered luminosity.
     """
 
     # -- convert to luminosity (high pass filter if desired)
-    hpL = (img if not hpf else ut.high_pass_filter(img, 10)).mean(-1)
+    if callable(hpf):
+        hpL = hpf(img)
+    else:
+        hpL = (img if not hpf else ut.high_pass_filter(img, 10)).mean(-1)
 
     # -- get medians and standard deviations of luminosity images
     med = np.median(hpL)
@@ -39,15 +46,120 @@ def locate_sources(img, hpf=False):
 
 
 
+def hist_median_std(hist, scale=1.0):
+    """
+    Return the median and standard deviation of integer valued
+    data from its histogram (hist[k] = number of elements equal
+    to k) without sorting the data. The median follows np.median
+    (average of the two middle elements for an even count).
+    The values are divided by scale.
+    """
+
+    vals = np.arange(hist.size, dtype=float)
+    cum  = np.cumsum(hist)
+    ntot = cum[-1]
+
+    # -- the value of the i-th sorted element is the first bin with
+    #    more than i elements at or below it
+    mid  = np.searchsorted(cum, [(ntot - 1) // 2, ntot // 2], side="right")
+    med  = 0.5 * (vals[mid[0]] + vals[mid[1]])
+
+    avg  = (hist * vals).sum() / float(ntot)
+    sig  = np.sqrt(max((hist * vals**2).sum() / float(ntot) - avg**2, 0.))
+
+    return med / scale, sig / scale
+
+
+def label_stats(mask):
+    """
+    Label the connected components of a boolean mask and return
+    the labels, the number of labels, and the size and centroid
+    (row, col) of each label, computed in a single pass.
+    """
+
+    labs, nlab = spm.label(mask)
+    rr, cc     = np.nonzero(labs)
+    ll         = labs[rr, cc]
+    lsz        = np.bincount(ll, minlength=nlab + 1)[1:].astype(float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        rcen = np.bincount(ll, weights=rr, minlength=nlab + 1)[1:] / lsz
+        ccen = np.bincount(ll, weights=cc, minlength=nlab + 1)[1:] / lsz
+
+    return labs, nlab, lsz, rcen, ccen
+
+
+def locate_sources_fast(img, hpf=False, binfac=4, nsig=5.0, 
+                        minsz=25., maxsz=500.):
+    """
+    Extract sources from a uint8 image, as locate_sources but:
+      - the median and standard deviation of the luminosity are
+        taken from its histogram instead of a full sort,
+      - candidates are detected on a (max) binned image,
+      - sizes and centroids are measured at full resolution only
+        in small windows around the candidates.
+    Falls back to locate_sources for non uint8 or high pass
+    filtered images.
+    """
+
+    if hpf or img.dtype != np.uint8:
+        return locate_sources(img, hpf=hpf)
+
+    # -- luminosity (times 3) as integers
+    lum3 = img.sum(-1, dtype=np.uint16)
+
+    # -- get median and standard deviation of luminosity from histogram
+    hist     = np.bincount(lum3.ravel(), minlength=3 * 255 + 1)
+    med, sig = hist_median_std(hist, scale=3.0)
+    thr3     = 3.0 * (med + nsig * sig)
+
+    # -- detect candidates on the binned image (a block is a candidate
+    #    if any of its pixels is above threshold)
+    nrow, ncol = lum3.shape
+    bmax = np.maximum.reduceat(np.maximum.reduceat(lum3, 
+                                                   np.arange(0, nrow, binfac), 
+                                                   axis=0), 
+                               np.arange(0, ncol, binfac), axis=1)
+    blabs, bnlab, bsz = label_stats(bmax > thr3)[:3]
+
+    # -- measure the sources at full resolution around each candidate
+    rcen, ccen = [], []
+    for ii, sl in enumerate(spm.find_objects(blabs)):
+        if bsz[ii] * binfac**2 <= minsz:
+            continue
+        rsl  = slice(sl[0].start * binfac, sl[0].stop * binfac)
+        csl  = slice(sl[1].start * binfac, sl[1].stop * binfac)
+
+        # -- only keep pixels in the blocks of this candidate
+        bwin = np.repeat(np.repeat(blabs[sl] == ii + 1, binfac, 0), 
+                         binfac, 1)
+        win  = lum3[rsl, csl]
+        thr  = (win > thr3) & bwin[:win.shape[0], :win.shape[1]]
+
+        lsz, rr, cc = label_stats(thr)[2:]
+        ind = (lsz > minsz) & (lsz < maxsz)
+        rcen.append(rr[ind] + rsl.start)
+        ccen.append(cc[ind] + csl.start)
+
+    if len(rcen) == 0:
+        return np.zeros((2, 0))
+
+    return np.array([np.concatenate(rcen), np.concatenate(ccen)])
+
+
 def get_catalog(ref="dobler2015_alt2"):
     """
     Return the row/col positions of the catalog sources.
 
     WARNING: These centroids were identified with a saturated image 
     (November 2, 2013, close to 23:00).  A new catalog should be made 
-    with an UNSATURATED image!!!
+    with an UNSATURATED image!!!  (ref can be the path of a catalog 
+    artifact built with catalog.py)
     """
 
+    if ref.endswith(CATALOG_EXT):
+        cat = load_catalog(ref)
+        return cat["rr_cat"].copy(), cat["cc_cat"].copy()
+
     if ref == "dobler2015_alt2":
         rr_cat = np.array([1597.8277796914979, 1495.0421522225859, 
                            1492.9830430088966, 1555.1681412623122, 
@@ -86,10 +198,35 @@ def get_catalog(ref="dobler2015_alt2"):
     return rr_cat, cc_cat
 
 
-def find_quads(dist, rr1, cc1, rr_cat, cc_cat, buff=10):
+# -- catalog positions and invariants computed in this process
+_invariants = {}
+
+def _catalog_invariants(ref):
     """
-    Find quads of sources with the appropriate distance ratios.
+    Return the positions, pairwise distance matrix and 0-1/0-2 angle 
+    of a catalog (computed or loaded once per process).
     """
+    if ref not in _invariants:
+        if ref.endswith(CATALOG_EXT):
+            cat = load_catalog(ref)
+            _invariants[ref] = (cat["rr_cat"], cat["cc_cat"], cat["dcatm"], 
+                                cat["dtheta_cat"])
+        else:
+            rr_cat, cc_cat   = get_catalog(ref=ref)
+            _invariants[ref] = (rr_cat, cc_cat) + \
+                catalog_invariants(rr_cat, cc_cat)
+
+    return _invariants[ref]
+
+
+def find_quads(dist, rr1, cc1, rr_cat, cc_cat, buff=10, dcatm=None):
+    """
+    Find quads of sources with the appropriate distance ratios.  The 
+    catalog distance matrix dcatm is computed if not given.
+    """
+
+    if dcatm is None:
+        dcatm = catalog_invariants(rr_cat, cc_cat)[0]
 
     # -- trim rows that do not have that distance distribution
     pts  = []
@@ -102,7 +239,7 @@ def find_quads(dist, rr1, cc1, rr_cat, cc_cat, buff=10):
     p6ind  = allind.copy()
 
     sub    = dist.copy()
-    dcat   = np.sqrt(((rr_cat[0] - rr_cat)**2 + (cc_cat[0] - cc_cat)**2))
+    dcat   = dcatm[0]
     dcat   = dcat[dcat>0]
     for tdist in dcat:
         tind  = (np.abs(sub - tdist) < buff).any(1)
@@ -110,7 +247,7 @@ def find_quads(dist, rr1, cc1, rr_cat, cc_cat, buff=10):
         p0ind = p0ind[tind]
 
     sub    = dist.copy()
-    dcat   = np.sqrt(((rr_cat[1] - rr_cat)**2 + (cc_cat[1] - cc_cat)**2))
+    dcat   = dcatm[1]
     dcat   = dcat[dcat>0]
     for tdist in dcat:
         tind  = (np.abs(sub - tdist) < buff).any(1)
@@ -118,7 +255,7 @@ def find_quads(dist, rr1, cc1, rr_cat, cc_cat, buff=10):
         p1ind = p1ind[tind]
 
     sub    = dist.copy()
-    dcat   = np.sqrt(((rr_cat[2] - rr_cat)**2 + (cc_cat[2] - cc_cat)**2))
+    dcat   = dcatm[2]
     dcat   = dcat[dcat>0]
     for tdist in dcat:
         tind  = (np.abs(sub - tdist) < buff).any(1)
@@ -127,16 +264,14 @@ def find_quads(dist, rr1, cc1, rr_cat, cc_cat, buff=10):
 
 
     sub    = dist.copy()
-    dcat   = np.sqrt(((rr_cat[6] - rr_cat)**2 + (cc_cat[6] - cc_cat)**2))
+    dcat   = dcatm[6]
     dcat   = dcat[dcat>0]
     for tdist in dcat:
         tind  = (np.abs(sub - tdist) < buff).any(1)
         sub   = sub[tind]
         p6ind = p6ind[tind]
 
-    dcat0 = np.sqrt(((rr_cat[0] - rr_cat)**2 + (cc_cat[0] - cc_cat)**2))
-    dcat1 = np.sqrt(((rr_cat[1] - rr_cat)**2 + (cc_cat[1] - cc_cat)**2))
-    dcat2 = np.sqrt(((rr_cat[2] - rr_cat)**2 + (cc_cat[2] - cc_cat)**2))
+    dcat0, dcat1, dcat2 = dcatm[:3]
 
     good01 = []
     for ii in p0ind:
@@ -168,50 +303,93 @@ def find_quads(dist, rr1, cc1, rr_cat, cc_cat, buff=10):
     return good0126
 
 
-def register(img, ref="dobler2015_alt2"):
+def match_quads(dist, rr1, cc1, rr_cat, cc_cat, buff=10, dcatm=None, 
+                quad=(0, 1, 2, 6)):
     """
-    Register an image to the catalog.
+    Find quads of sources with the appropriate distance ratios (same
+    inputs and output as find_quads, dist is not used).
+
+    Candidate (0, 1) pairs are found with a KD-tree pair search, the 
+    positions of the other two catalog sources are predicted from the 
+    rotation of each pair and looked up in the KD-tree, and all six 
+    distances of the resulting quads are verified at once.  Quads are 
+    returned in order of increasing distance residual.
     """
 
-    # -- extract sources
-    rr1, cc1 = locate_sources(img)
-
-    # -- get the catalog positions and distances (squared)
-    rr_cat, cc_cat = get_catalog(ref=ref)
-    dcat  = np.sqrt(((rr_cat[0] - rr_cat)**2 + (cc_cat[0] - cc_cat)**2)[1:])
-    dcatm = np.sqrt((rr_cat[:, np.newaxis] - rr_cat)**2 + 
-                    (cc_cat[:,np.newaxis] - cc_cat)**2)
-
-    # -- find the pairwise distance (squared) of all points
-    dist = np.sqrt((rr1[:, np.newaxis] - rr1)**2 + 
-                   (cc1[:,np.newaxis] - cc1)**2)
-
-    # -- find reasonable quads
-    good0126 = find_quads(dist, rr1, cc1, rr_cat, cc_cat)
-    p0s, p1s, p2s, p6s = np.array(good0126).T
-
-    # -- find the delta angles of the first 2 pairs
-    theta01 = np.arccos((rr1[p0s] - rr1[p1s]) / dist[p0s, p1s])
-    theta02 = np.arccos((rr1[p0s] - rr1[p2s]) / dist[p0s, p2s])
-    dtheta  = (theta01 - theta02) * 180. / np.pi
-
-    theta01_cat = np.arccos((rr_cat[0] - rr_cat[1]) / dcatm[0, 1])
-    theta02_cat = np.arccos((rr_cat[0] - rr_cat[2]) / dcatm[0, 2])
-    dtheta_cat  = (theta01_cat - theta02_cat) * 180. / np.pi
-
-    # -- choose the closest delta theta
-    guess = np.array(good0126[np.abs(dtheta - dtheta_cat).argmin()])
+    # -- catalog quad and its pairwise distances
+    quad = np.array(quad)
+    qr   = rr_cat[quad]
+    qc   = cc_cat[quad]
+    if dcatm is None:
+        dcat = np.sqrt((qr[:, np.newaxis] - qr)**2 + 
+                       (qc[:, np.newaxis] - qc)**2)
+    else:
+        dcat = dcatm[quad[:, np.newaxis], quad]
+
+    # -- find all pairs with the 0-1 catalog distance
+    pts  = np.array([rr1, cc1]).T
+    tree = cKDTree(pts)
+    prs  = tree.query_pairs(dcat[0, 1] + buff, output_type="ndarray")
+    if len(prs) == 0:
+        return np.zeros((0, 4), dtype=int)
+    prs  = np.vstack([prs, prs[:, ::-1]])
+    dprs = np.sqrt(((pts[prs[:, 0]] - pts[prs[:, 1]])**2).sum(1))
+    prs  = prs[(np.abs(dprs - dcat[0, 1]) < buff) & 
+               ((cc1[prs[:, 0]] - cc1[prs[:, 1]]) > 800)]
+    if len(prs) == 0:
+        return np.zeros((0, 4), dtype=int)
+
+    # -- rotation of each pair relative to the catalog
+    ang  = np.arctan2(cc1[prs[:, 1]] - cc1[prs[:, 0]], 
+                      rr1[prs[:, 1]] - rr1[prs[:, 0]]) - \
+        np.arctan2(qc[1] - qc[0], qr[1] - qr[0])
+    cs, sn = np.cos(ang), np.sin(ang)
+
+    # -- predicted positions of the 3rd and 4th sources
+    cands = []
+    for kk in [2, 3]:
+        dr   = qr[kk] - qr[0]
+        dc   = qc[kk] - qc[0]
+        pred = np.array([rr1[prs[:, 0]] + cs * dr - sn * dc, 
+                         cc1[prs[:, 0]] + sn * dr + cs * dc]).T
+        cands.append(tree.query_ball_point(pred, 2 * buff))
+
+    # -- all combinations of candidates for each pair
+    good = np.array([[p0, p1, p2, p6] 
+                     for (p0, p1), c2, c6 in zip(prs, cands[0], cands[1]) 
+                     for p2 in c2 for p6 in c6], dtype=int).reshape(-1, 4)
+    if len(good) == 0:
+        return good
+
+    # -- verify the distances and sort by residual
+    gr   = rr1[good]
+    gc   = cc1[good]
+    dgd  = np.sqrt((gr[:, :, np.newaxis] - gr[:, np.newaxis])**2 + 
+                   (gc[:, :, np.newaxis] - gc[:, np.newaxis])**2)
+    derr = np.abs(dgd - dcat)[:, np.triu_indices(4, 1)[0], 
+                              np.triu_indices(4, 1)[1]]
+    ind  = (derr < buff).all(1)
+    good = good[ind]
+
+    return good[(derr[ind]**2).sum(1).argsort()]
+
+
+def solve_transform(rrr0, ccc0, rrr1, ccc1, shape):
+    """
+    Least squares fit of the rotation/scaling [[a, -b], [b, a]] and 
+    offset (dr, dc) about the image center that maps the catalog 
+    positions (rrr0, ccc0) onto the image positions (rrr1, ccc1).
 
-    # -- calculate the offset and rotation
-    rrr0, ccc0 = rr_cat[np.array([0, 1, 2, 6])], cc_cat[np.array([0, 1, 2, 6])]
-    rrr1, ccc1 = rr1[guess], cc1[guess]
+    Returns the parameters [a, b, dr, dc] and the rms residual of 
+    the fit in pixels.
+    """
 
-    roff  = img.shape[0] // 2
-    coff  = img.shape[1] // 2
-    rrr0 -= roff
-    rrr1 -= roff
-    ccc0 -= coff
-    ccc1 -= coff
+    roff = shape[0] // 2
+    coff = shape[1] // 2
+    rrr0 = rrr0 - roff
+    rrr1 = rrr1 - roff
+    ccc0 = ccc0 - coff
+    ccc1 = ccc1 - coff
 
     mones      = np.zeros(rrr0.size*2+1)
     mones[::2] = 1.0
@@ -230,13 +408,194 @@ def register(img, ref="dobler2015_alt2"):
 
     pmTpm = np.dot(pm.T, pm)
     av    = np.dot(np.linalg.inv(pmTpm), np.dot(pm.T, bv))
+    res   = np.sqrt(((np.dot(pm, av) - bv)**2).reshape(-1, 2).sum(1).mean())
+
+    return av, res
+
+
+def register(img, ref="dobler2015_alt2", fast=False, matcher="kdtree"):
+    """
+    Register an image to the catalog.  If fast is True, sources are
+    extracted with locate_sources_fast.  The quads of sources are 
+    found with match_quads (matcher="kdtree") or with the original 
+    find_quads (matcher="loops"), which needs the full pairwise 
+    distance matrix of the sources.
+    """
 
+    # -- extract sources
+    rr1, cc1 = (locate_sources_fast if fast else locate_sources)(img)
+
+    # -- get the catalog positions, distances and angle
+    rr_cat, cc_cat, dcatm, dtheta_cat = _catalog_invariants(ref)
+
+    # -- find reasonable quads
+    if matcher == "loops":
+        dist     = np.sqrt((rr1[:, np.newaxis] - rr1)**2 + 
+                           (cc1[:,np.newaxis] - cc1)**2)
+        good0126 = find_quads(dist, rr1, cc1, rr_cat, cc_cat, dcatm=dcatm)
+    else:
+        good0126 = match_quads(None, rr1, cc1, rr_cat, cc_cat, dcatm=dcatm)
+    p0s, p1s, p2s, p6s = np.array(good0126).T
+
+    # -- find the delta angles of the first 2 pairs
+    dist01  = np.sqrt((rr1[p0s] - rr1[p1s])**2 + (cc1[p0s] - cc1[p1s])**2)
+    dist02  = np.sqrt((rr1[p0s] - rr1[p2s])**2 + (cc1[p0s] - cc1[p2s])**2)
+    theta01 = np.arccos((rr1[p0s] - rr1[p1s]) / dist01)
+    theta02 = np.arccos((rr1[p0s] - rr1[p2s]) / dist02)
+    dtheta  = (theta01 - theta02) * 180. / np.pi
+
+    # -- choose the closest delta theta
+    guess = np.array(good0126[np.abs(dtheta - dtheta_cat).argmin()])
+
+    # -- calculate the offset and rotation
+    quad   = np.array([0, 1, 2, 6])
+    av, _  = solve_transform(rr_cat[quad], cc_cat[quad], rr1[guess], 
+                             cc1[guess], img.shape)
     dr, dc = av[-2:]
     dtheta = np.arctan2(av[1],av[0]) * 180. / np.pi
 
     return -dr, -dc, -dtheta # minus sign registers *to* the catalog
 
 
+class RegistrationTracker(object):
+    """
+    Register a time ordered sequence of frames using the solution of 
+    the previous frame as a prior.
+
+    The catalog sources are only searched for in small windows around 
+    their positions predicted by the prior and the transformation is 
+    fit to the recovered centroids.  The full quad search (register) 
+    is used for the first frame and whenever fewer than `minsrc` 
+    sources are recovered or the rms residual of the fit exceeds 
+    `maxres` pixels.
+
+    Parameters
+    ----------
+    ref: str
+        catalog name (see get_catalog)
+    win: int
+        half size of the search windows in pixels
+    maxres: float
+        maximum rms residual (pixels) of a tracked solution
+    minsrc: int
+        minimum number of recovered catalog sources
+    nsig: float
+        detection threshold in standard deviations of the luminosity
+    minsz, maxsz: float
+        range of source sizes in pixels (as in locate_sources)
+    **kwargs:
+        passed to register for the full search (fast, matcher)
+    """
+
+    def __init__(self, ref="dobler2015_alt2", win=25, maxres=2.0, minsrc=4,
+                 nsig=5.0, minsz=25., maxsz=500., **kwargs):
+        self.ref    = ref
+        self.win    = win
+        self.maxres = maxres
+        self.minsrc = minsrc
+        self.nsig   = nsig
+        self.minsz  = minsz
+        self.maxsz  = maxsz
+        self.kwargs = kwargs
+
+        self.rr_cat, self.cc_cat = get_catalog(ref=ref)
+        self.prior  = None
+        self.ntrack = 0
+        self.nfull  = 0
+
+    def reset(self):
+        """
+        Forget the prior (e.g., at the start of a new night).
+        """
+        self.prior = None
+
+    def predict(self, shape):
+        """
+        Return the positions of the catalog sources in a frame of 
+        the given shape predicted by the prior.
+        """
+        a, b, dr, dc = self.prior
+        roff = shape[0] // 2
+        coff = shape[1] // 2
+        rr0  = self.rr_cat - roff
+        cc0  = self.cc_cat - coff
+
+        return a * rr0 - b * cc0 + dr + roff, b * rr0 + a * cc0 + dc + coff
+
+    def _centroids(self, img, rrp, ccp):
+        """
+        Return the centroids of the sources closest to the predicted 
+        positions (NaN if no source is found in the window).
+        """
+
+        # -- luminosity threshold from a subsample of the image
+        sub = img[::8, ::8].mean(-1)
+        thr = np.median(sub) + self.nsig * sub.std()
+
+        rr1 = np.full(rrp.size, np.nan)
+        cc1 = np.full(ccp.size, np.nan)
+        for ii, (rp, cp) in enumerate(zip(rrp, ccp)):
+            r0 = int(max(round(rp) - self.win, 0))
+            c0 = int(max(round(cp) - self.win, 0))
+            r1 = int(min(round(rp) + self.win + 1, img.shape[0]))
+            c1 = int(min(round(cp) + self.win + 1, img.shape[1]))
+            if (r1 <= r0) or (c1 <= c0):
+                continue
+
+            # -- label the sources in the window and keep the closest
+            labs, nlab, lsz, rcen, ccen = \
+                label_stats(img[r0:r1, c0:c1].mean(-1) > thr)
+            ind = (lsz > self.minsz) & (lsz < self.maxsz)
+            if not ind.any():
+                continue
+            rcen, ccen = rcen[ind] + r0, ccen[ind] + c0
+            best       = ((rcen - rp)**2 + (ccen - cp)**2).argmin()
+            rr1[ii]    = rcen[best]
+            cc1[ii]    = ccen[best]
+
+        return rr1, cc1
+
+    def track(self, img):
+        """
+        Register a frame using the prior only.  Returns the parameters 
+        [a, b, dr, dc] and the rms residual (None, inf if tracking 
+        fails).
+        """
+        if self.prior is None:
+            return None, np.inf
+
+        rr1, cc1 = self._centroids(img, *self.predict(img.shape))
+        ind      = np.isfinite(rr1)
+        if ind.sum() < self.minsrc:
+            return None, np.inf
+
+        return solve_transform(self.rr_cat[ind], self.cc_cat[ind], 
+                               rr1[ind], cc1[ind], img.shape)
+
+    def register(self, img):
+        """
+        Register a frame to the catalog (same output as register).
+        """
+
+        # -- try the prior first
+        av, res = self.track(img)
+        if res <= self.maxres:
+            self.ntrack += 1
+            self.prior   = av
+            dtheta       = np.arctan2(av[1], av[0]) * 180. / np.pi
+            return -av[2], -av[3], -dtheta
+
+        # -- fall back to the full search
+        self.nfull += 1
+        self.prior  = None
+        params      = register(img, ref=self.ref, **self.kwargs)
+        ang         = -params[2] * np.pi / 180.
+        self.prior  = np.array([np.cos(ang), np.sin(ang), -params[0], 
+                                -params[1]])
+
+        return params
+
+
 def get_reference_image():
     """
     Return the reference image for the Dobler et al. 2015 catalog.
@@ -259,8 +618,7 @@ def plot_registration(img, ref, params):
     rot   = img.mean(-1)
     scl1  = ref.mean(-1)
     rot  *= scl1.mean() / rot.mean()
-    rot   = nd.interpolation.shift(rot, (dr, dc))
-    rot   = nd.interpolation.rotate(rot, dt, reshape=False)
+    rot   = warp(rot, dr, dc, dt)
     comp  = np.dstack([scl1.clip(0,255).astype(np.uint8),
                        np.zeros(img.shape[:2],dtype=np.uint8),
                        rot.clip(0,255).astype(np.uint8)])
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Register all the nighttime frames of a date range with a pool of
+processes, appending the results to a single csv as they come in.
+Frames already in the csv are skipped, so an interrupted run is
+resumed by running the same command again.  The results are also
+written in batches to the files database (CUIP_DBNAME); in that case
+the database alone decides which frames are done, since the csv can
+be ahead of the last database batch when a run is interrupted.
+
+    python register_batch.py <start YYYY.MM.DD> <end YYYY.MM.DD> [nproc]
+"""
+
+import os
+import sys
+import csv
+import time
+import multiprocessing
+import uo_tools as ut
+from datetime import datetime
+from register import register
+from cuip.cuip.utils import cuiplogger
+
+logger = cuiplogger.cuipLogger(loggername="REGISTER", tofile=False)
+
+# -- columns of the output csv (same as register_block.py)
+REG_COLUMNS = ["fname", "fpath", "fnumber", "timestamp",
+               "drow", "dcol", "dtheta"]
+
+def _complete_row(row):
+    """
+    Return True if a csv row has all the columns and its
+    registration parameters parse as numbers.
+    """
+    if len(row) != len(REG_COLUMNS):
+        return False
+    try:
+        [float(val) for val in row[-3:]]
+    except ValueError:
+        return False
+    return True
+
+def registered_files(csvname):
+    """
+    Return the set of file names already in the output csv.
+    Incomplete lines (e.g., from an interrupted run) are ignored
+    so that those files are registered again, including a last
+    line without a line terminator, which may have been cut off
+    in the middle of a value.
+    """
+    if not os.path.isfile(csvname):
+        return set()
+    with open(csvname, "rb") as fopen:
+        lines = fopen.read().splitlines(True)
+    if lines and not lines[-1].endswith(("\n", "\r")):
+        lines = lines[:-1]
+    return set(row[0] for row in csv.reader(lines)
+               if row and row[0] != "fname" and _complete_row(row))
+
+def _drop_partial_line(csvname):
+    """
+    Remove a last line left without a line terminator by an
+    interrupted run, so that new rows start on a fresh line.
+    """
+    with open(csvname, "rb+") as fopen:
+        data = fopen.read()
+        if data and not data.endswith(("\n", "\r")):
+            fopen.truncate(max(data.rfind("\n"), data.rfind("\r")) + 1)
+
+def _register_one(args):
+    """
+    Worker function returning the registration parameters
+    (-9999 if the registration fails) of one frame.
+    """
+    row, fast, matcher = args
+    try:
+        img    = ut.read_raw(os.path.join(row[1], row[0]))
+        params = register(img, fast=fast, matcher=matcher)
+    except Exception as ex:
+        logger.error("Error registering "+str(row[0])+": "+str(ex))
+        params = [-9999, -9999, -9999]
+    return tuple(row) + tuple(params)
+
+def _db_session(dbname):
+    """
+    Return a session of the files database
+    """
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    engine = create_engine('postgresql:///{0}'.format(dbname))
+    return sessionmaker(bind=engine)()
+
+def unregistered(reg):
+    """
+    Return a boolean array of the files of a registration query
+    (see `cuip.cuip.utils.misc.get_registration`) that do not
+    have a solution yet.
+    """
+    return (reg["roffset"] == 0) & (reg["coffset"] == 0) & (reg["angle"] == 0)
+
+def register_files(rows, csvname=None, nproc=None, fast=False,
+                   matcher="kdtree", chunksize=4, dbname=None, batch_size=500):
+    """
+    Register a list of frames with a pool of processes and append
+    the results to a csv and/or write them to the files database.
+
+    Parameters
+    ----------
+    rows: list
+        list of (fname, fpath, fnumber, timestamp) of the frames
+    csvname: str, optional
+        output csv (created if needed, otherwise appended to)
+    nproc: int, optional
+        number of worker processes (default: number of cpus)
+    fast: bool
+        use locate_sources_fast to extract the sources
+    matcher: str
+        quad matcher used by register ("kdtree" or "loops")
+    chunksize: int
+        number of frames sent to a worker at once
+    dbname: str, optional
+        files database to write the results to.  The rows are then
+        expected to be the unregistered frames of the database and
+        none of them is skipped because it is already in the csv.
+    batch_size: int
+        number of results written to the database at once
+
+    Returns
+    -------
+    nreg: int
+        number of frames registered (excluding skipped frames)
+    """
+
+    # -- skip frames that are already registered (the csv is only
+    #    authoritative when there is no database to write to)
+    done  = registered_files(csvname) if csvname and not dbname else set()
+    todo  = [row for row in rows if row[0] not in done]
+    logger.info("Registering {0} files ({1} already done)" \
+                    .format(len(todo), len(rows) - len(todo)))
+    if len(todo) == 0:
+        return 0
+
+    # -- write the results to the database in batches
+    if dbname:
+        from cuip.cuip.database.add_files import UpdateRegistration
+        session = _db_session(dbname)
+    batch = []
+    def _flush():
+        if dbname and batch:
+            UpdateRegistration(batch, batch_size=batch_size)(session=session)
+        del batch[:]
+
+    # -- append each result as it is returned
+    nreg  = 0
+    fopen = None
+    pool  = multiprocessing.Pool(nproc or multiprocessing.cpu_count())
+    try:
+        if csvname:
+            # -- drop a line left incomplete by an interrupted run
+            if os.path.isfile(csvname):
+                _drop_partial_line(csvname)
+            new    = not os.path.isfile(csvname) or \
+                os.path.getsize(csvname) == 0
+            fopen  = open(csvname, "ab")
+            writer = csv.writer(fopen)
+            if new:
+                writer.writerow(REG_COLUMNS)
+        for res in pool.imap_unordered(_register_one,
+                                       [(row, fast, matcher) for row
+                                        in todo], chunksize=chunksize):
+            if fopen:
+                writer.writerow(res)
+                fopen.flush()
+            batch.append((res[1], res[0]) + res[-3:])
+            if len(batch) >= batch_size:
+                _flush()
+            nreg += 1
+            if nreg % 100 == 0:
+                logger.info("  registered {0} of {1} files" \
+                                .format(nreg, len(todo)))
+        _flush()
+    finally:
+        pool.close()
+        pool.join()
+        if fopen:
+            fopen.close()
+        if dbname:
+            session.close()
+
+    return nreg
+
+
+if __name__=="__main__":
+
+    # -- get time
+    t0 = time.time()
+
+    # -- get the date range
+    st    = datetime.strptime(sys.argv[1], "%Y.%m.%d")
+    en    = datetime.strptime(sys.argv[2], "%Y.%m.%d")
+    nproc = int(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    # -- query the database
+    from cuip.cuip.utils.misc import get_registration
+    db  = os.getenv("CUIP_DBNAME")
+    reg = get_registration(db, st, en)
+
+    # -- pull off nighttimes that do not have a solution yet
+    hr  = (reg["timestamp"] - reg["timestamp"].astype("datetime64[D]")) \
+        .astype("timedelta64[h]").astype(int)
+    ind = ((hr >= 19) | (hr < 5)) & unregistered(reg)
+
+    # -- register (use default catalog)
+    rows  = list(zip(reg["fname"][ind], reg["fpath"][ind],
+                     reg["fnumber"][ind],
+                     reg["timestamp"][ind].astype(datetime)))
+    oname = os.path.join("output", "register_{0}_{1}.csv" \
+                             .format(sys.argv[1], sys.argv[2]))
+    nreg  = register_files(rows, oname, nproc=nproc, dbname=db)
+
+    logger.info("FINISHED {0} files in {1}s".format(nreg, time.time() - t0))
@@ -8,6 +8,7 @@ import uo_tools as ut
 from datetime import datetime
 from register import *
 from cuip.cuip.utils.misc import get_files
+from cuip.cuip.fileio.prefetch import PrefetchReader
 
 if __name__=="__main__":
 
@@ -34,13 +35,15 @@ if __name__=="__main__":
 
     # -- register (use default catalog)
     dr, dc, dt = [], [], []
-    for ii, (rind, row) in enumerate(fl.iterrows()):
+    flist  = [os.path.join(fpath, fname) for fpath, fname in 
+              zip(fl.fpath, fl.fname)]
+    reader = PrefetchReader(flist, ut.read_raw, depth=4)
+    for ii, (infile, img) in enumerate(reader):
         if ii % 10 == 0:
             lopen.write("  registering file {0}\n".format(ii))
             lopen.flush()
-        infile = os.path.join(row.fpath, row.fname)
         try:
-            params = register(ut.read_raw(infile))
+            params = register(img)
             dr.append(params[0])
             dc.append(params[1])
             dt.append(params[2])
@@ -66,6 +69,7 @@ if __name__=="__main__":
     lopen.flush()
     fl.to_csv(os.path.join("output", "register_{0:04}.csv".format(ind)), 
               index=False)
+    lopen.write("waited {0}s on file reads\n".format(reader.stall))
     lopen.write("FINISHED in {0}s\n".format(time.time() - t0))
     lopen.flush()
     lopen.close()
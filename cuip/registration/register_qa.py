@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Quality assessment of the registration outputs (register_*.csv).
+
+The csvs are streamed in chunks keeping only the registration columns,
+the per frame metrics (failures and jumps relative to the neighbouring
+frames) are computed on the concatenated arrays, and a per night
+summary table is written.
+
+    python register_qa.py [<output dir> [<summary csv>]]
+"""
+
+import os
+import sys
+import glob
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from cuip.cuip.utils import cuiplogger
+
+logger = cuiplogger.cuipLogger(loggername="REGQA", tofile=False)
+
+# -- columns read from the registration outputs
+QA_COLUMNS = ["fname", "fpath", "timestamp", "drow", "dcol", "dtheta"]
+
+# -- value of the failed registrations
+FAILED = -9999
+
+def read_registrations(flist, chunksize=100000):
+    """
+    Stream registration csvs and return a DataFrame of the QA_COLUMNS
+    sorted by timestamp (duplicate files keep the last entry).
+    """
+    chunks = []
+    for fname in flist:
+        for chunk in pd.read_csv(fname, usecols=QA_COLUMNS,
+                                 parse_dates=["timestamp"],
+                                 chunksize=chunksize):
+            chunks.append(chunk.astype({"drow": np.float32,
+                                        "dcol": np.float32,
+                                        "dtheta": np.float32}))
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=QA_COLUMNS)
+
+    data = pd.concat(chunks, ignore_index=True)
+    data = data.drop_duplicates(subset=["fpath", "fname"], keep="last")
+
+    return data.sort_values(by="timestamp").reset_index(drop=True)
+
+
+def night_of(timestamps, noon=12):
+    """
+    Return the night (date of the evening) of each timestamp.
+    """
+    return (timestamps - pd.Timedelta(hours=noon)).dt.normalize()
+
+
+def frame_metrics(data, jump_px=20., jump_deg=0.5):
+    """
+    Add the per frame QA columns to a registration DataFrame (in place):
+
+    night: date of the evening of the night
+    failed: registration failed
+    jump: the offset or rotation differs by more than jump_px/jump_deg
+        from both the previous and next registered frames of the night
+        (an isolated outlier)
+    """
+    data["night"]  = night_of(data.timestamp)
+    data["failed"] = (data.drow == FAILED).values
+    data["jump"]   = False
+
+    # -- differences to the previous/next registered frame of the night
+    good  = data[~data.failed]
+    same  = (good.night.values[1:] == good.night.values[:-1])
+    dpar  = np.abs(np.diff(good[["drow", "dcol", "dtheta"]].values, axis=0))
+    big   = ((np.sqrt(dpar[:, 0]**2 + dpar[:, 1]**2) > jump_px) |
+             (dpar[:, 2] > jump_deg)) & same
+    jump  = np.zeros(len(good), dtype=bool)
+    jump[1:-1] = big[:-1] & big[1:]
+
+    data.loc[good.index, "jump"] = jump
+
+    return data
+
+
+def night_summary(data, nedge=30):
+    """
+    Return the per night summary of a registration DataFrame with the
+    frame metrics: number of frames, failures and jumps, median and
+    standard deviation of the registration parameters, and the drift
+    (difference of the medians of the last and first nedge registered
+    frames).
+    """
+    good = data[~data.failed & ~data.jump]
+    grp  = good.groupby("night")
+    pars = ["drow", "dcol", "dtheta"]
+
+    summ = data.groupby("night")[["failed", "jump"]].sum().astype(int) \
+        .rename(columns={"failed": "nfailed", "jump": "njump"})
+    summ.insert(0, "nframe", data.groupby("night").size())
+    summ["fail_rate"] = summ.nfailed / summ.nframe.astype(float)
+    summ = summ.join(grp[pars].median().add_suffix("_med"))
+    summ = summ.join(grp[pars].std().add_suffix("_std"))
+    summ = summ.join((grp[pars].apply(lambda x: x.tail(nedge).median()) -
+                      grp[pars].apply(lambda x: x.head(nedge).median())) \
+                         .add_suffix("_drift"))
+
+    return summ.reset_index()
+
+
+def read_thumb(fname, fac=4, nrow=2160, ncol=4096, nwav=3):
+    """
+    Return the fac subsampled (RGB) image of a raw file, reading
+    only the subsampled rows through a memory map.
+    """
+    img = np.memmap(fname, np.uint8, mode="r").reshape(nrow, ncol, nwav)
+    return np.array(img[::fac, ::fac, ::-1])
+
+
+def view_frames(df, nframe=16, fac=8, ncol=4, seed=314):
+    """
+    Show thumbnails of (a random subset of) the frames of a
+    registration DataFrame in a grid.
+    """
+    np.random.seed(seed)
+    rind = np.random.rand(len(df)).argsort()[:nframe]
+    rx   = df.iloc[rind].sort_values(by="timestamp")
+
+    plt.close("all")
+    nrow    = int(np.ceil(len(rx) / float(ncol)))
+    fig, ax = plt.subplots(nrow, ncol, figsize=(3. * ncol, 1.6 * nrow),
+                           squeeze=False)
+    fig.subplots_adjust(0, 0, 1, 0.95, 0.02, 0.15)
+    for axi in ax.flat:
+        axi.axis("off")
+    for axi, (_, rec) in zip(ax.flat, rx.iterrows()):
+        try:
+            axi.imshow(read_thumb(os.path.join(rec.fpath, rec.fname), fac))
+        except Exception as ex:
+            logger.error("Error reading "+str(rec.fname)+": "+str(ex))
+        axi.set_title("{0}  {1:.1f} {2:.1f} {3:.2f}" \
+                          .format(rec.timestamp, rec.drow, rec.dcol,
+                                  rec.dtheta), fontsize=6)
+    fig.canvas.draw()
+    plt.show()
+
+    return
+
+
+if __name__ == "__main__":
+
+    # -- stream all the registration outputs
+    dpath = sys.argv[1] if len(sys.argv) > 1 else "output"
+    oname = sys.argv[2] if len(sys.argv) > 2 else \
+        os.path.join(dpath, "register_summary.csv")
+    flist = sorted(glob.glob(os.path.join(dpath, "register_*.csv")))
+    flist = [f for f in flist if os.path.abspath(f) != os.path.abspath(oname)]
+    data  = frame_metrics(read_registrations(flist))
+
+    # -- write the summary
+    summ = night_summary(data)
+    summ.to_csv(oname, index=False)
+
+    print("{0} frames in {1} files, {2} nights".format(len(data), len(flist),
+                                                     len(summ)))
+    print("fraction not registered {0}".format(data.failed.mean()))
+    print("fraction of jumps       {0}".format(data.jump.mean()))
@@ -38,3 +38,109 @@ def high_pass_filter(img, sigma):
         return fimg - gf(fimg, sigma)
     else:
         return img - gf(img, sigma)
+
+
+class HighPassFilter(object):
+    """
+    High pass filter of the luminosity of a sequence of frames.
+
+    The frame is averaged to luminosity first and filtered in float32, 
+    and the result equals high_pass_filter(img, sigma).mean(-1) to 
+    float32 precision.  If binfac > 1, the low pass is computed on the 
+    luminosity binned by binfac and bilinearly upsampled.  All the 
+    arrays are allocated on the first call and reused for the 
+    following frames of the same shape.
+
+    NOTE: the returned array is overwritten by the next call (copy it 
+    to keep it).
+
+    Parameters
+    ----------
+    sigma: float
+        width of the gaussian low pass in pixels
+    binfac: int
+        factor to bin the luminosity by before the low pass
+    """
+
+    def __init__(self, sigma, binfac=1):
+        self.sigma  = sigma
+        self.binfac = binfac
+        self.shape  = None
+
+    def _allocate(self, shape):
+        """
+        Allocate the buffers and upsampling weights for a frame shape.
+        """
+        nrow, ncol  = shape[:2]
+        self.shape  = shape
+        self.lum    = np.empty((nrow, ncol), dtype=np.float32)
+        self.low    = np.empty((nrow, ncol), dtype=np.float32)
+        if self.binfac == 1:
+            return
+
+        # -- binned luminosity and bilinear weights (full resolution 
+        #    pixel x is at binned position (x - (binfac - 1) / 2) / binfac)
+        bf          = self.binfac
+        nr, nc      = nrow // bf, ncol // bf
+        self.small  = np.empty((nr, nc), dtype=np.float32)
+        self.slow   = np.empty((nr, nc), dtype=np.float32)
+        self.rows   = np.empty((2, nrow, nc), dtype=np.float32)
+        self.cols   = np.empty((nrow, ncol), dtype=np.float32)
+
+        def _weights(npix, nbin):
+            pos = ((np.arange(npix) - (bf - 1) / 2.) / bf).clip(0, nbin - 1)
+            ind = np.minimum(pos.astype(int), nbin - 2)
+            return ind, ind + 1, (pos - ind).astype(np.float32)
+
+        self.rind = _weights(nrow, nr)
+        self.cind = _weights(ncol, nc)
+
+    def _lowpass(self):
+        """
+        Low pass filter the luminosity into self.low.
+        """
+        if self.binfac == 1:
+            gf(self.lum, self.sigma, output=self.low)
+            return
+
+        # -- bin, filter and upsample (separately along each axis)
+        bf     = self.binfac
+        nr, nc = self.small.shape
+        self.lum[:nr*bf, :nc*bf].reshape(nr, bf, nc, bf) \
+            .mean(axis=(1, 3), out=self.small)
+        gf(self.small, self.sigma / float(bf), output=self.slow)
+
+        r0, r1, wr = self.rind
+        np.take(self.slow, r0, axis=0, out=self.rows[0])
+        np.take(self.slow, r1, axis=0, out=self.rows[1])
+        self.rows[1] -= self.rows[0]
+        self.rows[1] *= wr[:, np.newaxis]
+        self.rows[0] += self.rows[1]
+
+        c0, c1, wc = self.cind
+        np.take(self.rows[0], c0, axis=1, out=self.low)
+        np.take(self.rows[0], c1, axis=1, out=self.cols)
+        self.cols -= self.low
+        self.cols *= wc
+        self.low  += self.cols
+
+    def __call__(self, img):
+        """
+        Return the high pass filtered luminosity (nrow, ncol) of a 
+        frame (nrow, ncol, nwav) as float32.
+        """
+        if self.shape != img.shape:
+            self._allocate(img.shape)
+
+        # -- luminosity
+        if img.ndim == 3:
+            img.sum(axis=-1, dtype=np.float32, out=self.lum)
+            self.lum /= img.shape[-1]
+        else:
+            self.lum[...] = img
+
+        # -- subtract the low pass (in place)
+        self._lowpass()
+        np.subtract(self.lum, self.low, out=self.low)
+
+        return self.low
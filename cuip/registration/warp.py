@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Resample images with the registration parameters (dr, dc, dtheta) in
+a single pass.
+
+warp(img, dr, dc, dtheta) gives the same result as
+
+    nd.interpolation.rotate(nd.interpolation.shift(img, (dr, dc)),
+                            dtheta, reshape=False)
+
+but interpolates only once.  The coordinate maps are cached for the
+quantized parameters so that frames with the same registration reuse
+them.
+"""
+
+import numpy as np
+import scipy.ndimage as nd
+from collections import OrderedDict
+
+# -- quantization of the parameters (pixels and degrees)
+SHIFT_STEP = 0.01
+ANGLE_STEP = 0.001
+
+# -- number of coordinate maps kept (each map is 8 bytes per pixel,
+#    i.e., ~70MB for a full resolution frame)
+CACHE_SIZE = 4
+
+_cache = OrderedDict()
+
+def quantize(dr, dc, dtheta):
+    """
+    Return the registration parameters rounded to the quantization
+    steps (as integers of SHIFT_STEP and ANGLE_STEP).
+    """
+    return (int(round(dr / SHIFT_STEP)), int(round(dc / SHIFT_STEP)),
+            int(round(dtheta / ANGLE_STEP)))
+
+
+def warp_coords(shape, dr, dc, dtheta):
+    """
+    Return the input (row, col) coordinates (2, nrow, ncol) as float32
+    of each output pixel of an image of shape (nrow, ncol) shifted by
+    (dr, dc) and then rotated by dtheta degrees about its center.
+    """
+    nrow, ncol = shape[:2]
+    ang        = dtheta * np.pi / 180.
+    cs, sn     = np.cos(ang), np.sin(ang)
+    rcen, ccen = (nrow - 1) / 2., (ncol - 1) / 2.
+
+    rr = (np.arange(nrow, dtype=np.float32) - rcen)[:, np.newaxis]
+    cc = (np.arange(ncol, dtype=np.float32) - ccen)[np.newaxis, :]
+
+    coords    = np.empty((2, nrow, ncol), dtype=np.float32)
+    coords[0] = cs * rr + sn * cc + (rcen - dr)
+    coords[1] = cs * cc - sn * rr + (ccen - dc)
+
+    return coords
+
+
+def get_coords(shape, dr, dc, dtheta):
+    """
+    Return the (cached) coordinate map of the quantized registration
+    parameters.
+    """
+    key = (tuple(shape[:2]),) + quantize(dr, dc, dtheta)
+    if key in _cache:
+        coords = _cache.pop(key)
+    else:
+        coords = warp_coords(shape, key[1] * SHIFT_STEP, key[2] * SHIFT_STEP,
+                             key[3] * ANGLE_STEP)
+    if CACHE_SIZE > 0:
+        while len(_cache) >= CACHE_SIZE:
+            _cache.popitem(last=False)
+        _cache[key] = coords
+
+    return coords
+
+
+def clear_cache():
+    """
+    Release the cached coordinate maps.
+    """
+    _cache.clear()
+
+
+def warp(img, dr, dc, dtheta, order=1, cval=0.0):
+    """
+    Shift an image by (dr, dc) and rotate it by dtheta degrees about
+    its center in a single interpolation.
+
+    Parameters
+    ----------
+    img: np.ndarray
+        image (nrow, ncol) or (nrow, ncol, nwav)
+    dr, dc, dtheta: float
+        registration parameters (as returned by register.register)
+    order: int
+        order of the spline interpolation (1 is bilinear)
+    cval: float
+        value of the pixels outside of the input image
+
+    Returns
+    -------
+    warped image (float) of the same shape as img
+    """
+    coords = get_coords(img.shape, dr, dc, dtheta)
+
+    if img.ndim == 2:
+        return nd.map_coordinates(img, coords, order=order, cval=cval)
+
+    out = np.empty(img.shape, dtype=np.result_type(img.dtype, np.float32))
+    for ii in range(img.shape[2]):
+        nd.map_coordinates(img[..., ii], coords, output=out[..., ii],
+                           order=order, cval=cval)
+
+    return out
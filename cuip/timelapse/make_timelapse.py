@@ -7,6 +7,7 @@ import numpy as np
 from datetime import datetime
 from scipy.misc import imsave
 from cuip.cuip.utils.misc import query_db
+from cuip.cuip.fileio.prefetch import PrefetchReader
 
 def read_raw(fname):
     """
@@ -15,6 +16,12 @@ def read_raw(fname):
     return np.memmap(fname, np.uint8, mode="r") \
         .reshape(2160, 4096, 3)[..., ::-1]
 
+def read_thumb(fname):
+    """
+    Return the 4x subsampled image (read into memory).
+    """
+    return np.array(read_raw(fname)[::4, ::4])
+
 # -- set start and end times
 syn   = "\n  syntax is \n    python make_timelapse.py y1.m1.d1 y2.m2.d2\n"
 
@@ -44,15 +51,17 @@ sub = fl[::6]
 nsub = len(sub)
 
 # -- make jpgs
-base = "img_{0:05}.jpg"
-for ii in range(nsub):
+base   = "img_{0:05}.jpg"
+flist  = [os.path.join(sub.iloc[ii].fpath, sub.iloc[ii].fname) 
+          for ii in range(nsub)]
+reader = PrefetchReader(flist, read_thumb, depth=8, nthreads=4)
+for ii, (fname, thumb) in enumerate(reader):
     if (ii + 1) % 10 == 0:
         print("\r{0:5} of {1}".format(ii + 1, nsub)),
         sys.stdout.flush()
-    imsave(base.format(ii), 
-           read_raw(os.path.join(sub.iloc[ii].fpath, 
-                                 sub.iloc[ii].fname))[::4, ::4])
+    imsave(base.format(ii), thumb)
 print("")
+print("waited {0:.1f}s on file reads".format(reader.stall))
 
 # -- make movie
 cmd = "ffmpeg -r 30 -i img_%05d.jpg -qscale 0 night_{0}_{1}.mp4"
@@ -1,5 +1,6 @@
 import os
 import psycopg2
+import numpy as np
 import multiprocessing
 import pandas as pd
 from datetime import datetime, timedelta
@@ -74,7 +75,8 @@ def get_files(dbname, start_datetime, end_datetime, df=False):
     Returns
     -------
     files: list
-        list of absolute paths of the files
+        list of tuples of (absolute path, fnumber, timestamp)
+        of the files (or a DataFrame if df is True)
     """
     f_tbname = os.getenv("CUIP_TBNAME")
     conn     = psycopg2.connect("dbname='%s'"%(dbname))
@@ -87,11 +89,54 @@ def get_files(dbname, start_datetime, end_datetime, df=False):
 
     if not df:
         cur.execute(query, {'start': start_datetime, 'end': end_datetime})
-        return [(os.path.join(x[1], x[0]), x[2]) for x in cur.fetchall()]
+        return [(os.path.join(x[1], x[0]), x[2], x[3]) for x in cur.fetchall()]
     else:
         return pd.read_sql_query(query, conn, params={'start': start_datetime, 
                                                       'end': end_datetime})
 
+def get_registration(dbname, start_datetime, end_datetime):
+    """
+    Fetch the registration parameters of all files between
+    `start_datetime` and `end_datetime` from database `dbname`.
+    Files that are not registered yet have roffset, coffset
+    and angle all equal to 0 (failed registrations are -9999).
+    Parameters
+    ----------
+    dbname: str
+        postgres database name
+    start_datetime: `datetime.datetime`
+        start datetime from which to get the files
+    end_datetime: `datetime.datetime`
+        end datetime until which to get the files
+    Returns
+    -------
+    reg: dict
+        dict of numpy arrays fname, fpath, fnumber, timestamp
+        (datetime64[s]), roffset, coffset and angle ordered by
+        timestamp
+    """
+    f_tbname = os.getenv("CUIP_TBNAME")
+    conn     = psycopg2.connect("dbname='%s'"%(dbname))
+    cur      = conn.cursor()
+    query    = "SELECT fname, fpath, fnumber, timestamp, \
+                roffset, coffset, angle \
+                FROM {tbname}     \
+                WHERE timestamp     \
+                BETWEEN %(start)s and %(end)s ORDER BY timestamp;" \
+        .format(tbname=f_tbname)
+    cur.execute(query, {'start': start_datetime, 'end': end_datetime})
+    rows = cur.fetchall()
+    conn.close()
+
+    cols = zip(*rows) if rows else [[]] * 7
+    return {"fname"    : np.array(cols[0], dtype=object),
+            "fpath"    : np.array(cols[1], dtype=object),
+            "fnumber"  : np.array(cols[2], dtype=np.int64),
+            "timestamp": np.array(cols[3], dtype="datetime64[s]"),
+            "roffset"  : np.array(cols[4], dtype=float),
+            "coffset"  : np.array(cols[5], dtype=float),
+            "angle"    : np.array(cols[6], dtype=float)}
+
 def _pathrange(basepath, start, end, delta):
     """
     Generate paths for datetime between `start` and `end`
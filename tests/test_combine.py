@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+The pipelined stacking of combine must write every stack, including
+the last ones still being written when the worker processes exit.
+"""
+from __future__ import print_function, absolute_import, division
+
+import os
+import time
+import numpy as np
+import pytest
+
+pytest.importorskip("sqlalchemy")
+from cuip.cuip.hadoop import combine
+from cuip.cuip.hadoop.combine import stack_groups, stack_name
+from cuip.cuip.fileio.manifest import read_manifest
+
+NROW, NCOL, NWAV = 8, 16, 3
+
+
+def test_stack_groups(tmpdir, monkeypatch):
+    rand   = np.random.RandomState(10)
+    inpath = tmpdir.mkdir("raw")
+    dpath  = str(tmpdir.mkdir("stacked"))
+    binfac = 2
+
+    # -- more groups than processes, the last one not full
+    frames    = {}
+    flist_out = {}
+    for gid, nimg in enumerate([3, 3, 3, 3, 3, 2]):
+        tflist = []
+        for ii in range(nimg):
+            fnumber = 10 * gid + ii
+            fname   = str(inpath.join("{0}.raw".format(fnumber)))
+            frames[fnumber] = rand.randint(0, 256, (NROW, NCOL, NWAV)) \
+                .astype(np.uint8)
+            frames[fnumber].tofile(fname)
+            tflist.append((fname, fnumber, None))
+        flist_out[gid] = tflist
+
+    # -- slow down the writes so that the last ones are still in flight
+    #    when the workers are told to exit (the workers are forked, so
+    #    they inherit the patched function)
+    write_stack = combine._write_stack
+    def _slow_write(*args):
+        time.sleep(0.5)
+        write_stack(*args)
+    monkeypatch.setattr(combine, "_write_stack", _slow_write)
+
+    written = stack_groups(flist_out, dpath, binfac, 3, nproc=2, nthreads=2,
+                           nrow=NROW, ncol=NCOL, nwav=NWAV)
+
+    dr = NROW // binfac
+    assert sorted(written) == sorted(stack_name(dpath, tflist)
+                                     for tflist in flist_out.values())
+    for tflist in flist_out.values():
+        fname = stack_name(dpath, tflist)
+        stack = np.fromfile(fname, dtype=np.uint8) \
+            .reshape(3 * dr, NCOL // binfac, NWAV)
+        for ii, tfile in enumerate(tflist):
+            np.testing.assert_array_equal(
+                stack[dr*ii:dr*(ii+1)],
+                frames[tfile[1]][::binfac, ::binfac, ::-1])
+        assert (stack[dr*len(tflist):] == 0).all()
+        assert read_manifest(fname)["fnumber"].tolist() == \
+            [tfile[1] for tfile in tflist]
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Reading stacked files on Spark as fixed length records must give the
+same subimages as reading them directly.
+"""
+from __future__ import print_function, absolute_import, division
+
+import os
+import numpy as np
+import pytest
+
+pyspark = pytest.importorskip("pyspark")
+from cuip.cuip.fileio.cuip_io import _fromrecords, _readstack
+
+NROW, NCOL, NWAV, NSTACK = 4, 6, 3, 3
+
+
+@pytest.fixture(scope="module")
+def sc():
+    sc = pyspark.SparkContext("local[2]", "test_cuip_io")
+    yield sc
+    sc.stop()
+
+
+def test_fromrecords(sc, tmpdir):
+    rand      = np.random.RandomState(11)
+    flist     = []
+    filenames = {}
+
+    # -- the second stack has fewer file names than subimages
+    for first, last in [(0, 2), (3, 4)]:
+        fpath = str(tmpdir.join("{0}_{1}.raw".format(first, last)))
+        rand.randint(0, 256, (NSTACK, NROW, NCOL, NWAV)).astype(np.uint8) \
+            .tofile(fpath)
+        flist.append(fpath)
+        filenames["{0}_{1}".format(first, last)] = \
+            ["{0}.raw".format(ii) for ii in range(first, last + 1)]
+
+    expected = {}
+    for fpath in flist:
+        stack  = _readstack(fpath, NROW, NCOL, NWAV, NSTACK, np.uint8)
+        fnames = filenames[os.path.basename(fpath).strip(".raw")]
+        for fname, img in zip(fnames, stack):
+            expected[fname] = img
+
+    res = _fromrecords(sc, flist, filenames, NROW, NCOL, NWAV, np.uint8) \
+        .map(lambda cia: (cia.metadata["fname"], np.array(cia))).collect()
+
+    assert sorted(fname for fname, img in res) == sorted(expected)
+    for fname, img in res:
+        np.testing.assert_array_equal(img, expected[fname])
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+The bincount CDF of detect_match must give the same output as the
+np.unique implementation it replaces.
+"""
+from __future__ import print_function, absolute_import, division
+
+import numpy as np
+import pytest
+
+pytest.importorskip("cv2")
+from cuip.cuip import detect_match as dm
+
+
+def unique_cdf(img, return_inverse=False):
+    """
+    img_cdf as computed with np.unique.
+    """
+    uniq = np.unique(img, return_counts=True, return_inverse=return_inverse)
+    f = np.cumsum(uniq[-1]).astype(np.float64)
+    f /= f[-1]
+    if return_inverse:
+        return uniq[0], f, uniq[1]
+    return uniq[0], f
+
+
+def assert_same(res, ref):
+    assert len(res) == len(ref)
+    for arr, arr_ref in zip(res, ref):
+        assert arr.dtype == arr_ref.dtype
+        np.testing.assert_array_equal(arr, arr_ref)
+
+
+@pytest.mark.parametrize("return_inverse", [False, True])
+def test_img_cdf_uint8(return_inverse):
+    img = np.random.RandomState(1).randint(0, 256, (120, 160)) \
+        .astype(np.uint8)
+    img[img == 37] = 36
+
+    assert dm._bincountable(img)
+    assert_same(dm.img_cdf(img, return_inverse=return_inverse),
+                unique_cdf(img, return_inverse=return_inverse))
+
+
+@pytest.mark.parametrize("return_inverse", [False, True])
+def test_img_cdf_weighted(return_inverse):
+    # -- weighted image as built by neighborhood_cdf (large enough
+    #    for its range to be histogrammed)
+    gry = np.uint32(np.random.RandomState(2).randint(0, 256, (400, 400)))
+    img = gry * 2048
+    img[1:-1, 1:-1] += gry[:-2, 1:-1] + gry[2:, 1:-1] + gry[1:-1, :-2] + \
+        gry[1:-1, 2:]
+
+    assert dm._bincountable(img)
+    assert_same(dm.img_cdf(img, return_inverse=return_inverse),
+                unique_cdf(img, return_inverse=return_inverse))
+
+
+def test_img_cdf_fallback():
+    # -- negative and float images still go through np.unique
+    img = np.random.RandomState(3).randint(-5, 5, (20, 30))
+    assert not dm._bincountable(img)
+    assert_same(dm.img_cdf(img, return_inverse=True),
+                unique_cdf(img, return_inverse=True))
+
+    img = np.random.RandomState(4).rand(20, 30)
+    assert not dm._bincountable(img)
+    assert_same(dm.img_cdf(img), unique_cdf(img))
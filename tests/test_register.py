@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+The fast source extraction and quad matching of register must agree
+with the reference implementations.
+"""
+from __future__ import print_function, absolute_import, division
+
+import os
+import sys
+import numpy as np
+import pytest
+
+pytest.importorskip("matplotlib")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "cuip",
+                                "registration"))
+import register as reg
+
+
+def sort_sources(rr, cc):
+    order = np.lexsort((cc, rr))
+    return rr[order], cc[order]
+
+
+@pytest.fixture
+def sources_img():
+    rand = np.random.RandomState(6)
+    img  = rand.randint(10, 30, (300, 400, 3)).astype(np.uint8)
+    rr, cc = np.mgrid[:300, :400]
+
+    # -- disks of 30 to 300 pixels, one pair closer than a bin
+    for rcen, ccen, rad in [(40, 50, 4), (40, 62, 3.5), (150, 200, 9),
+                            (250, 330, 6), (103, 371, 5), (270, 20, 4.5)]:
+        img[(rr - rcen)**2 + (cc - ccen)**2 <= rad**2] = 250
+
+    # -- too small and too large sources
+    img[200:204, 100:104] = 250
+    img[10:40, 200:230]   = 250
+
+    return img
+
+
+def test_hist_median_std():
+    vals = np.random.RandomState(7).randint(0, 766, 1001)
+    for data in [vals, vals[:-1]]:
+        med, sig = reg.hist_median_std(np.bincount(data, minlength=766),
+                                       scale=3.0)
+        assert med == np.median(data) / 3.0
+        assert np.allclose(sig, data.std() / 3.0)
+
+
+def test_locate_sources_fast(sources_img):
+    rr, cc     = sort_sources(*reg.locate_sources(sources_img))
+    rrf, ccf   = sort_sources(*reg.locate_sources_fast(sources_img))
+
+    assert len(rr) == 6
+    np.testing.assert_allclose(rrf, rr)
+    np.testing.assert_allclose(ccf, cc)
+
+
+def test_locate_sources_fast_empty():
+    img = np.full((64, 64, 3), 20, dtype=np.uint8)
+    assert reg.locate_sources_fast(img).shape == (2, 0)
+
+
+def catalog_sources(dtheta, dr, dc, nextra=60, seed=8):
+    """
+    Return the catalog sources rotated by dtheta degrees about the frame
+    center and shifted by (dr, dc), followed by random extra sources.
+    """
+    rr_cat, cc_cat = reg.get_catalog()
+    ang  = dtheta * np.pi / 180.
+    rcen, ccen = 2160 // 2, 4096 // 2
+    rr1  = np.cos(ang) * (rr_cat - rcen) - np.sin(ang) * (cc_cat - ccen) + \
+        rcen + dr
+    cc1  = np.sin(ang) * (rr_cat - rcen) + np.cos(ang) * (cc_cat - ccen) + \
+        ccen + dc
+
+    rand = np.random.RandomState(seed)
+    return (np.concatenate([rr1, rand.rand(nextra) * 2160]),
+            np.concatenate([cc1, rand.rand(nextra) * 4096]))
+
+
+@pytest.mark.parametrize("dtheta", [-3., 0., 1.5, 4.])
+def test_match_quads(dtheta):
+    rr_cat, cc_cat = reg.get_catalog()
+    rr1, cc1 = catalog_sources(dtheta, 12.3, -25.6)
+    dist     = np.sqrt((rr1[:, np.newaxis] - rr1)**2 +
+                       (cc1[:, np.newaxis] - cc1)**2)
+    true     = [0, 1, 2, 6]
+
+    loops  = reg.find_quads(dist, rr1, cc1, rr_cat, cc_cat)
+    kdtree = reg.match_quads(None, rr1, cc1, rr_cat, cc_cat)
+
+    # -- the true quad is found by both and ranked first by match_quads
+    assert true in loops.tolist()
+    assert kdtree[0].tolist() == true
+    assert set(map(tuple, kdtree)) <= set(map(tuple, loops))
+
+
+def test_match_quads_none():
+    rr_cat, cc_cat = reg.get_catalog()
+    rand = np.random.RandomState(9)
+    assert reg.match_quads(None, rand.rand(5) * 100, rand.rand(5) * 100,
+                           rr_cat, cc_cat).shape == (0, 4)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+The single pass warp must match the scipy shift followed by rotate.
+"""
+from __future__ import print_function, absolute_import, division
+
+import os
+import sys
+import numpy as np
+import pytest
+import scipy.ndimage as nd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "cuip",
+                                "registration"))
+import warp
+
+
+@pytest.fixture
+def smooth():
+    img = np.random.RandomState(5).rand(120, 160) * 255.
+    return nd.gaussian_filter(img, 4)
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    warp.clear_cache()
+    yield
+    warp.clear_cache()
+
+
+@pytest.mark.parametrize("params", [(3.4, -7.25, 0.), (0., 0., 1.3),
+                                    (-2.6, 5.1, -0.8)])
+def test_warp_matches_shift_rotate(smooth, params):
+    dr, dc, dtheta = params
+    ref = nd.interpolation.rotate(nd.interpolation.shift(smooth, (dr, dc)),
+                                  dtheta, reshape=False)
+    res = warp.warp(smooth, dr, dc, dtheta)
+
+    # -- compare away from the edges (filled differently)
+    sl = (slice(15, -15), slice(15, -15))
+    np.testing.assert_allclose(res[sl], ref[sl], atol=0.05 * smooth.std())
+
+
+def test_warp_channels(smooth):
+    img = np.dstack([smooth, 2 * smooth, smooth[::-1]])
+    res = warp.warp(img, 1.5, -2.5, 0.7)
+
+    assert res.shape == img.shape
+    for ii in range(3):
+        np.testing.assert_allclose(res[..., ii],
+                                   warp.warp(img[..., ii], 1.5, -2.5, 0.7),
+                                   rtol=1e-5, atol=1e-3)
+
+
+def test_get_coords_cache(monkeypatch):
+    monkeypatch.setattr(warp, "CACHE_SIZE", 2)
+    coords = warp.get_coords((40, 50), 1.0, 2.0, 0.5)
+
+    # -- parameters within the quantization steps share a map
+    assert warp.get_coords((40, 50), 1.001, 2.0, 0.5) is coords
+
+    warp.get_coords((40, 50), 3.0, 2.0, 0.5)
+    warp.get_coords((40, 50), 4.0, 2.0, 0.5)
+    assert len(warp._cache) == 2
+
+
+def test_get_coords_no_cache(monkeypatch):
+    monkeypatch.setattr(warp, "CACHE_SIZE", 0)
+    coords = warp.get_coords((40, 50), 1.0, 2.0, 0.5)
+
+    assert coords.shape == (2, 40, 50)
+    assert len(warp._cache) == 0
+    np.testing.assert_array_equal(warp.get_coords((40, 50), 1.0, 2.0, 0.5),
+                                  coords)